@@ -0,0 +1,187 @@
+"""
+知识库的HTTP接口，供后端服务直接调用，不经过gradio：检索、问答(SSE流式)、上传入库、文件列表、任务状态
+运行: python api.py  以API_WORKERS个进程运行，各进程内存映射同一个合并库索引文件
+上传、删除提交到后台任务队列，全局逐个执行；执行任务的进程写入合并库后，其余进程在下一次请求时重新加载
+"""
+import asyncio
+import json
+import shutil
+from typing import Dict, List, Optional, Union
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from langchain.schema import HumanMessage
+from pydantic import BaseModel, Field
+
+from configs.model_config import *
+from utils.chat import astream_chat, build_context, build_kn_query
+from utils.jobs import JobQueue
+from utils.utils import VectorStore
+
+vector_store = VectorStore()
+job_queue = JobQueue()
+app = FastAPI(title="知识库接口")
+RETRIEVAL_MODES = ("hybrid", "vector")
+
+
+@app.on_event("startup")
+def startup():
+    # 在每个worker进程中执行，python api.py 的主进程只负责管理worker，不加载知识库
+    # 只读加载，不修复；所有进程都启动工作线程，但只有拿到任务队列锁文件的一个进程执行任务
+    vector_store.load_knowledge_base()
+    job_queue.start()
+
+
+class SearchRequest(BaseModel):
+    # 一个问题，或多个问题(一次embedding请求、一次矩阵检索)
+    query: Union[str, List[str]]
+    k: int = Field(4, ge=1)
+    # metadata过滤条件，如 {"source": 路径} 或 {"category": "cn_Title"}
+    filter: Optional[Dict] = None
+    mode: str = RETRIEVAL_MODE
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+
+
+class AskRequest(BaseModel):
+    question: str
+    k: int = Field(4, ge=1)
+    min_score: float = 0.25
+    filter: Optional[Dict] = None
+    mode: str = RETRIEVAL_MODE
+    temperature: float = 0.7
+    # 为False时等回答生成完一次返回
+    stream: bool = True
+
+
+def _doc_json(doc, score):
+    return {"text": doc.page_content, "metadata": doc.metadata, "score": score}
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _search(queries, vectors, k, mode, filter=None, nprobe=None, ef_search=None):
+    """返回每个问题的 [(Document, score), ...]，两种模式的score都是越大越相关"""
+    if mode not in RETRIEVAL_MODES:
+        raise HTTPException(400, f"mode只能是{RETRIEVAL_MODES}之一")
+    vector_store.reload_if_changed()
+    if mode == "hybrid":
+        return [vector_store.hybrid_search_with_score(query, vector, k, nprobe=nprobe, ef_search=ef_search,
+                                                      filter=filter)
+                for query, vector in zip(queries, vectors)]
+    results = vector_store.batch_similarity_search_with_score_by_vector(vectors, k, nprobe, ef_search, filter)
+    return [vector_store.to_similarity(hits) for hits in results]
+
+
+@app.post("/search")
+async def search(request: SearchRequest):
+    queries = [request.query] if isinstance(request.query, str) else request.query
+    vectors = await asyncio.to_thread(vector_store.embeddings.embed_queries, queries)
+    # 检索是CPU计算和本地磁盘读取，放到线程中执行，不阻塞事件循环
+    results = await asyncio.to_thread(_search, queries, vectors, request.k, request.mode, request.filter,
+                                      request.nprobe, request.ef_search)
+    results = [[_doc_json(doc, score) for doc, score in hits] for hits in results]
+    return {"results": results[0] if isinstance(request.query, str) else results}
+
+
+@app.post("/ask")
+async def ask(request: AskRequest):
+    """stream时依次发送 sources(检索到的分段)、多个 token、done(完整回答) 三种SSE事件"""
+    # 先加载其他进程写入的合并库，再读版本号查缓存，刚入库、删除的文件不会命中旧版本的回答
+    await asyncio.to_thread(vector_store.reload_if_changed)
+    query_vector = await vector_store.embeddings.aembed_query(request.question)
+    version = vector_store.version
+    # 影响检索结果和生成回答的参数都要放进缓存键，只有stream(返回方式)不影响
+    cache_params = ("api", request.k, request.min_score, request.mode,
+                    str(sorted(request.filter.items())) if request.filter else None, request.temperature)
+    cached = vector_store.answer_cache.get(query_vector, version, cache_params)
+    if cached is not None:
+        sources, answer = cached
+        messages = None
+    else:
+        docs_and_scores = (await asyncio.to_thread(_search, [request.question], [query_vector], request.k,
+                                                   request.mode, request.filter))[0]
+        sources = [_doc_json(doc, score) for doc, score in docs_and_scores if score >= request.min_score]
+        contexts = [f"Document{i + 1}:{doc.page_content}\n" for i, (doc, score) in enumerate(docs_and_scores)
+                    if score >= request.min_score]
+        messages = build_context([HumanMessage(content=build_kn_query(request.question, contexts))])
+        answer = None
+
+    async def generate():
+        nonlocal answer
+        if answer is None:
+            answer = ""
+            async for token in astream_chat(messages, temperature=request.temperature):
+                answer += token
+                yield token
+            vector_store.answer_cache.put(query_vector, version, cache_params, (sources, answer))
+        else:
+            yield answer
+
+    if not request.stream:
+        return {"answer": "".join([token async for token in generate()]), "sources": sources}
+
+    async def events():
+        yield _sse("sources", sources)
+        async for token in generate():
+            yield _sse("token", token)
+        yield _sse("done", {"answer": answer})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _save_upload(file: UploadFile, file_path):
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(file.file, f)
+
+
+@app.post("/ingest")
+async def ingest(files: List[UploadFile] = File(...), sentence_size: int = Form(SENTENCE_SIZE)):
+    """文件保存到docs目录后提交后台入库任务，立即返回任务号，进度查询/jobs/{job_id}"""
+    os.makedirs(DOCS_PATH, exist_ok=True)
+    file_paths = []
+    for file in files:
+        file_path = os.path.join(DOCS_PATH, os.path.basename(file.filename))
+        await asyncio.to_thread(_save_upload, file, file_path)
+        file_paths.append(file_path)
+    return {"job_id": job_queue.submit_ingest(file_paths, sentence_size=sentence_size)}
+
+
+@app.get("/sources")
+async def sources():
+    """知识库中的文件：文件名 -> 路径"""
+    await asyncio.to_thread(vector_store.reload_if_changed)
+    return {"sources": vector_store.get_docs_dict()}
+
+
+@app.delete("/sources/{filename}")
+async def delete_source(filename: str):
+    await asyncio.to_thread(vector_store.reload_if_changed)
+    if filename not in vector_store.get_docs_dict():
+        raise HTTPException(404, f"文件{filename}不存在")
+    return {"job_id": job_queue.submit_delete([filename])}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: int):
+    status = job_queue.status(job_id)
+    if status is None:
+        raise HTTPException(404, f"任务{job_id}不存在")
+    return status
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: int):
+    return {"cancelled": job_queue.cancel(job_id)}
+
+
+@app.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: int):
+    return {"job_id": job_queue.retry(job_id)}
+
+
+if __name__ == "__main__":
+    uvicorn.run("api:app", host=HOST, port=API_PORT, workers=API_WORKERS)
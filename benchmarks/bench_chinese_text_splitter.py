@@ -0,0 +1,104 @@
+"""
+ChineseTextSplitter.split_text 新旧实现的一致性校验与耗时对比
+运行: python benchmarks/bench_chinese_text_splitter.py --sizes 0.5 1 2
+same 列为False时，差异只来自旧实现的bug：重复出现的超长片段会被 ls.index 定位到第一个副本上切分
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from textsplitter import ChineseTextSplitter
+
+
+def legacy_split_text(text, pdf=False, sentence_size=100):
+    """重写之前的实现，逐个超长句子用 ls.index + 切片 重建列表，句子数多时为平方复杂度"""
+    if pdf:
+        text = re.sub(r"\n{3,}", r"\n", text)
+        text = re.sub('\s', " ", text)
+        text = re.sub("\n\n", "", text)
+
+    text = re.sub(r'([;；.!?。！？\?])([^”’])', r"\1\n\2", text)
+    text = re.sub(r'(\.{6})([^"’”」』])', r"\1\n\2", text)
+    text = re.sub(r'(\…{2})([^"’”」』])', r"\1\n\2", text)
+    text = re.sub(r'([;；!?。！？\?]["’”」』]{0,2})([^;；!?，。！？\?])', r'\1\n\2', text)
+    text = text.rstrip()
+    ls = [i for i in text.split("\n") if i]
+    for ele in ls:
+        if len(ele) > sentence_size:
+            ele1 = re.sub(r'([,，.]["’”」』]{0,2})([^,，.])', r'\1\n\2', ele)
+            ele1_ls = ele1.split("\n")
+            for ele_ele1 in ele1_ls:
+                if len(ele_ele1) > sentence_size:
+                    ele_ele2 = re.sub(r'([\n]{1,}| {2,}["’”」』]{0,2})([^\s])', r'\1\n\2', ele_ele1)
+                    ele2_ls = ele_ele2.split("\n")
+                    for ele_ele2 in ele2_ls:
+                        if len(ele_ele2) > sentence_size:
+                            ele_ele3 = re.sub('( ["’”」』]{0,2})([^ ])', r'\1\n\2', ele_ele2)
+                            ele2_id = ele2_ls.index(ele_ele2)
+                            ele2_ls = ele2_ls[:ele2_id] + [i for i in ele_ele3.split("\n") if i] + ele2_ls[
+                                                                                                   ele2_id + 1:]
+                    ele_id = ele1_ls.index(ele_ele1)
+                    ele1_ls = ele1_ls[:ele_id] + [i for i in ele2_ls if i] + ele1_ls[ele_id + 1:]
+
+            id = ls.index(ele)
+            ls = ls[:id] + [i for i in ele1_ls if i] + ls[id + 1:]
+    return ls
+
+
+def make_text(size_mb, seed=0):
+    """随机生成中文文本，混合短句、带引号的句子、只有逗号的长句和只有空格的长句"""
+    rng = random.Random(seed)
+    chars = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+    ends = ["。", "！", "？", "；", "……", "......", "。”", "！」"]
+    parts = []
+    size = 0
+    target = int(size_mb * 1024 * 1024)
+    while size < target:
+        kind = rng.random()
+        if kind < 0.7:
+            part = "".join(rng.choices(chars, k=rng.randint(5, 60))) + rng.choice(ends)
+        elif kind < 0.85:
+            part = "，".join("".join(rng.choices(chars, k=rng.randint(10, 40))) for _ in range(rng.randint(3, 8))) + "。"
+        elif kind < 0.95:
+            part = "  ".join("".join(rng.choices(chars, k=rng.randint(20, 60))) for _ in range(rng.randint(3, 6))) + "。"
+        else:
+            part = " ".join("".join(rng.choices(chars, k=rng.randint(30, 90))) for _ in range(rng.randint(3, 6))) + "\n"
+        parts.append(part)
+        size += len(part.encode("utf-8"))
+    return "".join(parts)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[0.5, 1, 2], help="文本大小(MB)")
+    parser.add_argument("--sentence-size", type=int, default=100)
+    parser.add_argument("--skip-legacy", action="store_true", help="只测新实现")
+    args = parser.parse_args()
+
+    print(f"{'size(MB)':>9} {'pdf':>5} {'sentences':>10} {'new(s)':>8} {'legacy(s)':>10} {'speedup':>8} same")
+    for size_mb in args.sizes:
+        text = make_text(size_mb)
+        for pdf in (False, True):
+            splitter = ChineseTextSplitter(pdf=pdf, sentence_size=args.sentence_size)
+            new, new_time = timed(splitter.split_text, text)
+            if args.skip_legacy:
+                print(f"{size_mb:>9} {str(pdf):>5} {len(new):>10} {new_time:>8.3f} {'-':>10} {'-':>8} -")
+                continue
+            old, old_time = timed(legacy_split_text, text, pdf=pdf, sentence_size=args.sentence_size)
+            print(f"{size_mb:>9} {str(pdf):>5} {len(new):>10} {new_time:>8.3f} {old_time:>10.3f} "
+                  f"{old_time / new_time:>7.1f}x {new == old}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+合并库各种索引类型相对暴力检索(flat)的召回率与查询耗时对比
+运行: python benchmarks/bench_faiss_index.py --n 200000 --dim 768
+      python benchmarks/bench_faiss_index.py --index vector_store/zhishiku/all_old/index.faiss
+recall 为近似索引的top-k与flat的top-k的重合比例，ms/q 为单条查询(batch=1)的平均耗时
+"""
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.faiss_index import build_index, reconstruct_all, search_params
+
+
+def make_vectors(n, dim, clusters=256, seed=0):
+    """高斯混合分布的向量，比均匀随机更接近真实文本embedding的聚簇结构"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    vectors = centers[labels] + 0.3 * rng.normal(size=(n, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def make_queries(vectors, nq, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), nq, replace=False)]
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def timed_search(index, queries, k, params=None):
+    """逐条查询，模拟问答时每次只检索一个问题"""
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    start = time.perf_counter()
+    for i in range(len(queries)):
+        indices[i] = index.search(queries[i:i + 1], k, params=params)[1][0]
+    return indices, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall(found, truth):
+    k = truth.shape[1]
+    return sum(len(set(f) & set(t)) for f, t in zip(found, truth)) / (len(truth) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="已有的index.faiss，取其中的向量测试；不指定则生成随机向量")
+    parser.add_argument("--n", type=int, default=100000, help="随机向量数")
+    parser.add_argument("--dim", type=int, default=768, help="随机向量维度")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--types", nargs="+", default=["ivf_flat", "ivf_pq", "hnsw"])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    args = parser.parse_args()
+
+    if args.index:
+        source = faiss.read_index(args.index)
+        vectors, metric = reconstruct_all(source), source.metric_type
+    else:
+        vectors, metric = make_vectors(args.n, args.dim), faiss.METRIC_L2
+    queries = make_queries(vectors, min(args.queries, len(vectors)))
+    print(f"向量数{len(vectors)}，维度{vectors.shape[1]}，查询{len(queries)}条，k={args.k}")
+
+    flat = build_index(vectors, "flat", metric)
+    truth, flat_ms = timed_search(flat, queries, args.k)
+    print(f"{'type':<10}{'param':<14}{'build s':>9}{'recall':>9}{'ms/q':>9}{'speedup':>9}")
+    print(f"{'flat':<10}{'':<14}{0:>9.1f}{1:>9.3f}{flat_ms:>9.3f}{1:>9.1f}")
+    for index_type in args.types:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type, metric)
+        build_s = time.perf_counter() - start
+        if index_type == "hnsw":
+            settings = [(f"efSearch={ef}", search_params(index, ef_search=ef)) for ef in args.ef_search]
+        else:
+            settings = [(f"nprobe={nprobe}", search_params(index, nprobe=nprobe)) for nprobe in args.nprobe]
+        for label, params in settings:
+            found, ms = timed_search(index, queries, args.k, params)
+            print(f"{index_type:<10}{label:<14}{build_s:>9.1f}{recall(found, truth):>9.3f}{ms:>9.3f}"
+                  f"{flat_ms / ms:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+各入口模块的导入耗时(基于 python -X importtime)，并检查不该在启动时导入的重型依赖
+运行: python benchmarks/import_time.py
+      python benchmarks/import_time.py utils.utils api --top 20 --budget-ms 3000
+每个模块在独立的新进程中导入，互不影响；cumulative 为包含依赖的总耗时，self 为模块自身耗时
+出现 --forbid 中的模块、或总耗时超过 --budget-ms 时以非0退出，可作为启动速度的回归检查
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 问答服务启动时不需要的依赖：本地模型、PDF/图片解析、OCR、语义切分，以及第一次请求时才用到的OpenAI客户端
+HEAVY_MODULES = ["torch", "paddleocr", "paddle", "fitz", "nltk", "modelscope", "unstructured", "openai", "aiohttp"]
+# 各入口都依赖的基础包；它自身导入的模块(如部分版本的langchain导入aiohttp)不算入口模块引入的重型依赖
+BASELINE_MODULE = "langchain"
+
+
+def import_profile(module):
+    """
+    :return: [(self_us, cumulative_us, depth, name), ...] 按导入完成的顺序
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(errors[-1] if errors else proc.returncode)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # 名字前的缩进表示被谁导入，每层两个空格
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # app、api在模块级创建VectorStore、JobQueue，一并检查创建它们时是否导入了重型依赖
+    parser.add_argument("modules", nargs="*", default=["utils.utils", "utils.jobs", "utils.chat", "loader",
+                                                       "textsplitter", "app", "api"])
+    parser.add_argument("--top", type=int, default=10, help="列出自身耗时最多的模块数")
+    parser.add_argument("--budget-ms", type=float, default=None, help="单个入口模块导入总耗时上限")
+    parser.add_argument("--forbid", nargs="*", default=HEAVY_MODULES, help="不允许被导入的模块(含其子模块)")
+    args = parser.parse_args()
+
+    failed = False
+    try:
+        baseline = {name for _, _, _, name in import_profile(BASELINE_MODULE)}
+    except RuntimeError:
+        baseline = set()
+    for module in args.modules:
+        try:
+            rows = import_profile(module)
+        except RuntimeError as e:
+            print(f"{module}: 导入失败 {e}")
+            failed = True
+            continue
+        # 顶层各条之和即这条import语句的总耗时
+        total_ms = sum(cumulative for _, cumulative, depth, _ in rows if depth == 0) / 1000
+        names = {name for _, _, _, name in rows}
+        forbidden = sorted(name for name in names - baseline if name.split(".")[0] in args.forbid)
+        print(f"{module}: {total_ms:.0f} ms, {len(rows)} modules")
+        for self_us, cumulative_us, _, name in sorted(rows, reverse=True)[:args.top]:
+            print(f"    self {self_us / 1000:8.1f} ms  cumulative {cumulative_us / 1000:8.1f} ms  {name}")
+        if forbidden:
+            print(f"    不应在导入时加载: {', '.join(forbidden)}")
+            failed = True
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            print(f"    超出预算 {args.budget_ms:.0f} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
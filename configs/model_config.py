@@ -1,13 +1,124 @@
 import logging
+import multiprocessing
 import os
-import openai
 # 正常应该是127.0.0.1
 HOST = "0.0.0.0"
 PORT = 8888
 SHARE = False
-openai.proxy = "127.0.0.1:7890"
+# gradio同时处理的请求数；查询读取合并库的只读快照，可以与上传、删除并发
+GRADIO_CONCURRENCY = 4
+# HTTP检索/问答接口(api.py)的端口和worker进程数；各worker内存映射同一个合并库索引文件，共享页缓存
+API_PORT = 8000
+API_WORKERS = 4
+# OpenAI请求走的代理，第一次创建客户端时设置，配置模块本身不导入openai
+OPENAI_PROXY = "http://127.0.0.1:7890"
 os.environ["OPENAI_API_KEY"] = ''
+# OpenAI接口地址，测试时可指向本地的兼容服务
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+# 同时进行的OpenAI请求数上限，以及限流、超时等错误的重试次数和退避等待秒数
+LLM_MAX_CONCURRENCY = 16
+LLM_MAX_RETRIES = 5
+LLM_RETRY_BASE_WAIT = 1
+LLM_RETRY_MAX_WAIT = 30
 VS_ROOT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "vector_store")
+# 上传的文件保存在该目录，同步时以它为准增量更新知识库
+DOCS_PATH = os.path.join(VS_ROOT_PATH, "docs")
+# 聊天模型名
+CHAT_MODEL = "gpt-3.5-turbo"
+# 每次请求发送的对话历史token上限(含系统提示和本轮提问)，超出的早期轮次被丢弃
+CHAT_HISTORY_TOKEN_BUDGET = 3000
+# embedding模型名，同时作为向量缓存键的一部分
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# 单次embedding请求最多发送的分段数，OpenAI接口一次最多接受2048条，更多的分批请求
+EMBEDDING_BATCH_SIZE = 1000
+# embedding后端: "openai" 调用接口; "local" 在本机CPU上运行LOCAL_EMBEDDING_MODEL
+# 不同模型的向量维度不同，切换后端后需要重建已有的知识库
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "openai")
+# 本地模型名或路径(huggingface格式)、推理线程数、动态批处理的批大小与凑批等待毫秒数、最大token长度、是否int8动态量化
+LOCAL_EMBEDDING_MODEL = "shibing624/text2vec-base-chinese"
+LOCAL_EMBEDDING_THREADS = os.cpu_count() or 1
+LOCAL_EMBEDDING_BATCH_SIZE = 32
+LOCAL_EMBEDDING_MAX_WAIT_MS = 5
+LOCAL_EMBEDDING_MAX_LENGTH = 256
+LOCAL_EMBEDDING_QUANTIZE = False
+# 分段向量缓存，按 模型名+文本 哈希保存，重复上传的文件不再请求embedding接口
+EMBEDDING_CACHE_PATH = os.path.join(VS_ROOT_PATH, "embedding_cache", "embeddings.db")
+# 合并库中的文件目录(文件名->路径、分段数、向量位置区间等)；每次提交写一个带代号的新文件，如 sources.3.json
+SOURCE_CATALOG_FILE = "sources.json"
+# 旧版本记录已删除向量位置的文件，现在墓碑记在分段存储里
+TOMBSTONES_FILE = "tombstones.json"
+# 记录合并库当前一代的索引、文件目录、分段存储文件名，提交时整体替换这个文件完成切换
+MANIFEST_FILE = "manifest.json"
+# 已删除向量占比超过该值时压缩合并库
+VS_COMPACT_RATIO = 0.3
+# 合并库的加载方式: "mmap" 内存映射索引文件，分段文本在检索命中时才从磁盘读取，多个进程共享页缓存，启动耗时与库大小无关；
+# "memory" 把索引全部读入内存。两种方式下写入(上传、删除、压缩)前都会先把索引完整读入内存
+VS_LOAD_MODE = "mmap"
+# 合并库分段存储(SQLite)的文件名，以及SQLite内存映射读取的字节数上限
+CHUNK_STORE_FILE = "chunks.db"
+CHUNK_STORE_MMAP_SIZE = 1 << 30
+# 合并库的索引类型: "flat" 暴力检索; "ivf_flat"、"ivf_pq"、"hnsw" 近似检索
+# 合并库向量数达到VS_INDEX_TRAIN_THRESHOLD时自动训练并转换，之前一直使用flat
+VS_INDEX_TYPE = "flat"
+VS_INDEX_TRAIN_THRESHOLD = 100000
+# IVF聚类中心数(0为按 4*sqrt(向量数) 自动取值)；PQ子向量数(须整除向量维度，否则自动调小)与每段编码位数
+VS_IVF_NLIST = 0
+VS_PQ_M = 64
+VS_PQ_NBITS = 8
+# HNSW每个节点的邻居数与建图时的候选数
+VS_HNSW_M = 32
+VS_HNSW_EF_CONSTRUCTION = 200
+# 默认查询参数，可在每次检索时单独指定：IVF探查的聚类数、HNSW查询时的候选数，越大召回越高、越慢
+VS_NPROBE = 16
+VS_EF_SEARCH = 64
+# 缓存多少个过滤条件的IDSelector位图(含墓碑)，合并库改动后失效
+VS_SELECTOR_CACHE_SIZE = 64
+# 多进程部署时，只读进程每隔多少秒检查一次合并库是否被其他进程改动
+VS_RELOAD_CHECK_SECONDS = 1.0
+# 读取manifest之后、打开它指向的文件之前，写入方可能又提交了新的一代并删除了这些文件，重读manifest的次数
+VS_LOAD_RETRIES = 3
+# 批量入库：解析切分OCR类文件(PDF、图片)的进程数，纯文本类文件、需要联网拉取的文件(订阅源)各自的解析线程数，
+# 每次embedding请求的分段数、并发请求数、累计多少分段提交一次合并库
+INGEST_PROCESSES = os.cpu_count() or 1
+INGEST_THREADS = 4
+INGEST_NETWORK_THREADS = 8
+# 解析进程池的启动方式：gradio、任务队列、embedding等线程运行中fork，子进程可能继承被其他线程持有的锁(如logging)而死锁，
+# 所以不用fork；forkserver/spawn会在子进程中重新导入启动脚本，入口脚本的启动代码要放在 if __name__ == "__main__" 下
+MP_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+EMBED_BATCH_SIZE = 256
+EMBED_CONCURRENCY = 4
+INGEST_COMMIT_CHUNKS = 5000
+# 后台入库任务队列：任务库路径、工作线程和页面查询任务状态的间隔秒数；合并库写入是串行的，任务逐个执行
+JOBS_DB_PATH = os.path.join(VS_ROOT_PATH, "jobs.db")
+JOB_POLL_SECONDS = 2
+# 上传的.feeds订阅源列表文件中允许在线拉取的主机名；为空时不拉取任何订阅源，
+# 避免任何能上传文件的人让服务器去请求内网地址、云主机元数据接口等
+RSS_ALLOWED_HOSTS = []
+# 每个进程最多同时持有的PaddleOCR引擎数，引擎在首次OCR时才加载
+OCR_POOL_SIZE = 1
+# PDF内嵌图片宽或高小于该像素数时不做OCR(图标、分隔线等)
+OCR_MIN_IMAGE_SIZE = 32
+# 单个PDF按页并行抽取的进程数，以及每个进程一次处理的页数
+PDF_PAGE_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 8
+# 知识库问答的检索方式: "vector" 只用向量检索；"hybrid" 向量检索与BM25关键词检索按倒数排名融合，
+# 型号、编号、生僻词更容易命中，融合后的分数归一化到[0, 1]
+RETRIEVAL_MODE = "hybrid"
+# 融合时向量与关键词两路的权重、每路取的候选数，以及倒数排名融合的平滑常数
+HYBRID_VECTOR_WEIGHT = 1.0
+HYBRID_LEXICAL_WEIGHT = 1.0
+HYBRID_CANDIDATES = 50
+HYBRID_RRF_K = 60
+# 关键词检索时忽略出现在超过该比例分段中的高频词；出现在不超过LEXICAL_MIN_MAX_DF个分段中的词总是保留，
+# 否则小知识库里出现在两三个分段中的词也会被当作高频词丢掉
+LEXICAL_MAX_DF_RATIO = 0.05
+LEXICAL_MIN_MAX_DF = 500
+# 问题向量的LRU缓存条数(按原文精确匹配)
+QUERY_EMBEDDING_CACHE_SIZE = 10000
+# 知识库问答的语义答案缓存：条数、过期秒数、命中所需的问题向量余弦相似度；知识库有改动时自动失效
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 3600
+ANSWER_CACHE_SIMILARITY = 0.97
 NLTK_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "nltk_data")
 # 文本分句长度
 SENTENCE_SIZE = 100
@@ -2,6 +2,7 @@ import time
 import gradio as gr
 from utils import *
 from langchain.chat_models import ChatOpenAI
+from configs.model_config import OPENAI_PROXY
 
 
 # 初始化记忆池
@@ -25,7 +26,7 @@ def chat(query, chat_chatbot, system_prompt, temperature):
             chat_history.add_system_message(system_prompt)
 
     chat_history.add_user_message(query)
-    chat = ChatOpenAI(temperature=temperature, model_name="gpt-3.5-turbo")
+    chat = ChatOpenAI(temperature=temperature, model_name="gpt-3.5-turbo", openai_proxy=OPENAI_PROXY)
 
     response = chat(chat_history.messages)
     chat_history.add_ai_message(response.content)
@@ -96,7 +97,7 @@ def kn_chat(know_ask_input, chat_chatbot, kv_num=4, min_score=0.3):
 
             """
     chatkn_history.add_user_message(query)
-    chat = ChatOpenAI(model_name="gpt-3.5-turbo")
+    chat = ChatOpenAI(model_name="gpt-3.5-turbo", openai_proxy=OPENAI_PROXY)
     response = chat(chatkn_history.messages)
     chatkn_history.add_ai_message(response.content)
     chat_chatbot.append((know_ask_input, response.content + "\n" + kn_vector))
@@ -146,4 +147,6 @@ with gr.Blocks() as demo:
                           outputs=[know_ask_input, chatbot_kn])
     vector_store_creat_button.click(save_file, inputs=[docs_input, sentence_size], outputs=docx_text)
     vector_store_delete_button.click(vector_store.delete_vector_store, outputs=docx_text)
-demo.launch(server_name='0.0.0.0', server_port=8888)
+# PDF按页解析的进程池以forkserver/spawn方式启动时会重新导入本脚本，只在直接运行时启动网页
+if __name__ == "__main__":
+    demo.launch(server_name='0.0.0.0', server_port=8888)
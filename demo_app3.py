@@ -1,10 +1,11 @@
+import asyncio
 import os.path
 import shutil
-import time
 import gradio as gr
 from configs.model_config import *
-from langchain.chat_models import ChatOpenAI
 from utils.utils import ChatMessageHistory, load_file, VectorStore
+from utils.jobs import JobQueue
+from utils.chat import astream_chat, build_context, build_kn_query
 from langchain.schema import (
     AIMessage,
     BaseChatMessageHistory,
@@ -13,39 +14,34 @@ from langchain.schema import (
     SystemMessage
 )
 
-# 初始化记忆池
-chat_history = ChatMessageHistory()
-chatkn_history = ChatMessageHistory()
 # 初始化向量数据库
 vector_store = VectorStore()
 vector_store.create_vector_store(documents=None)
 vs_file_dict = vector_store.get_docs_dict()
+# 上传、删除、同步在后台任务队列中执行，上次未完成的任务在启动时继续
+job_queue = JobQueue()
+JOB_KIND_NAMES = {"ingest": "入库", "delete": "删除", "sync": "同步", "clear": "清空"}
+# 任务状态显示最近的任务数
+JOB_STATUS_LIMIT = 5
 
 
 def delete_one_file(vs_file_choice_dropdown):
-    global vs_file_dict
-    info = ""
-    vs_file_dict = vector_store.get_docs_dict()
-    if isinstance(vs_file_dict, dict) and len(vs_file_dict) > 0:
-        try:
-            info = vector_store.delete_one_vector_store(source=vs_file_choice_dropdown)
-        except Exception as e:
-            info += f"dict is not exist,{e}"
-            logger.exception(f"dict is not exist,{e}")
-    else:
-        info += "数据库为空"
-        return info, gr.Dropdown.update(choices=None)
-    vs_file_dict = vector_store.get_docs_dict()
-    if len(vs_file_dict) == 0:
-        info = vector_store.delete_vector_store()
-    return info, gr.Dropdown.update(choices=list(vs_file_dict.keys()))
+    """提交后台删除任务，文件列表在任务完成后随任务状态刷新"""
+    if not vector_store.get_docs_dict():
+        return "数据库为空", gr.Dropdown.update(choices=None)
+    if not vs_file_choice_dropdown:
+        return "请先选择要删除的文件", gr.Dropdown.update()
+    job_id = job_queue.submit_delete([vs_file_choice_dropdown])
+    return f"已提交删除任务{job_id}", gr.Dropdown.update()
 
 
 def delete_all_file():
-    global vs_file_dict
-    info = vector_store.delete_vector_store()
-    vs_file_dict = vector_store.get_docs_dict()
-    return info, gr.Dropdown.update(choices=list(vs_file_dict.keys()))
+    """
+    清空知识库也走任务队列：直接删除时，其他进程正在执行的入库任务会在删除后重新建出知识库
+    文件列表在任务完成后随任务状态刷新
+    """
+    job_id = job_queue.submit_clear()
+    return f"已提交清空数据库任务{job_id}", gr.Dropdown.update()
 
 
 def move_file(source_path, destination_path):
@@ -60,71 +56,130 @@ def move_file(source_path, destination_path):
 
 def build_vs_by_file(files, sentence_size):
     """
-        建立数据库的回调函数，先读取文件，再
+        建立数据库的回调函数，先把文件移动到docs目录，再提交后台入库任务，不等解析、embedding完成就返回
     """
-    vector_store = VectorStore()
-    directory_path = os.path.join(VS_ROOT_PATH, "docs")
+    directory_path = DOCS_PATH
     os.makedirs(directory_path, exist_ok=True)  # 创建保存文件的目录
-    try:
-        if isinstance(files, list):
-            result = []
-            for file in files:
-                filebasename = os.path.basename(file.name)
-                file_path = os.path.join(directory_path, filebasename)
-                result.append(move_file(file.name, file_path))
-                try:
-                    documents = load_file(file_path, sentence_size=sentence_size)
-                    vector_store.create_vector_store(documents=documents, source=filebasename.split('.')[0])
-                except Exception as e:
-                    logger.warning(f"failed to load file {file},{e}")
-                    result = f"failed to load file {file},{e}"
+    if not isinstance(files, list):
+        files = [files]
+    result = []
+    file_paths = []
+    for file in files:
+        file_path = os.path.join(directory_path, os.path.basename(file.name))
+        info = move_file(file.name, file_path)
+        if os.path.exists(file_path):
+            file_paths.append(file_path)
         else:
-            filebasename = os.path.basename(files.name)
-            file_path = os.path.join(directory_path, filebasename)
-            result = move_file(files.name, file_path)
-            try:
-                documents = load_file(file_path, sentence_size=sentence_size)
-                vector_store.create_vector_store(documents=documents,source=filebasename.split('.')[0])
-            except Exception as e:
-                logger.warning(f"failed to load file {files},{e}")
-                result = f"failed to load file {files},{e}"
-    except Exception as e:
-        logger.warning("failed to build vector_store")
-        result = f"failed to add file {str(files)} vector_store,error:{e}"
-    vs_file_dict = vector_store.get_docs_dict()
-    return result, gr.Dropdown.update(choices=list(vs_file_dict.keys()))
+            result.append(info)
+    if file_paths:
+        job_id = job_queue.submit_ingest(file_paths, sentence_size=sentence_size)
+        result.append(f"已提交入库任务{job_id}，共{len(file_paths)}个文件，进度见任务状态")
+    return "\n".join(result), gr.Dropdown.update()
+
+
+def sync_docs_dir(sentence_size):
+    """
+        提交按docs目录增量同步的后台任务，只重新入库新增和改动的文件，删除已不存在的文件
+    """
+    job_id = job_queue.submit_sync(sentence_size=sentence_size)
+    return f"已提交同步任务{job_id}，进度见任务状态", gr.Dropdown.update()
 
 
-def chat(query, chat_chatbot, system_prompt, temperature):
+def job_status_text():
+    """最近几个后台任务及其中每个文件所处的阶段"""
+    lines = []
+    for job in job_queue.list_jobs(JOB_STATUS_LIMIT):
+        lines.append(f"任务{job['id']} {JOB_KIND_NAMES[job['kind']]} {job['status']} {job['done']}/{job['total']}"
+                     + (f" {job['error']}" if job["error"] else ""))
+        for file in job["files"]:
+            # 失败的文件附上原因
+            reason = f" {file['info']}" if file["stage"] == "failed" else ""
+            lines.append(f"    {file['filename']}: {file['stage']}{reason}")
+    return "\n".join(lines)
+
+
+def poll_jobs():
+    """页面定时刷新任务状态；任务改动了知识库的文件时同时刷新文件列表"""
+    global vs_file_dict
+    # 任务可能由API等其他进程执行，先加载它写入的合并库
+    vector_store.reload_if_changed()
+    docs_dict = vector_store.get_docs_dict()
+    if docs_dict.keys() == vs_file_dict.keys():
+        return job_status_text(), gr.Dropdown.update()
+    vs_file_dict = docs_dict
+    return job_status_text(), gr.Dropdown.update(choices=list(vs_file_dict.keys()))
+
+
+def cancel_job(job_id):
+    if job_queue.cancel(int(job_id)):
+        return f"已取消任务{int(job_id)}，正在处理的文件完成后停止"
+    return f"任务{int(job_id)}不存在或已经结束"
+
+
+def retry_job(job_id):
+    new_job_id = job_queue.retry(int(job_id))
+    if new_job_id is None:
+        return f"任务{int(job_id)}没有失败或被取消的文件"
+    return f"已把任务{int(job_id)}中失败的文件重新提交为任务{new_job_id}"
+
+
+async def chat(query, chat_chatbot, system_prompt, temperature, chat_history):
     if len(chat_history.messages) > 0:
         if type(chat_history.messages[0]) is SystemMessage:
             if system_prompt:
                 chat_history.messages[0] = SystemMessage(content=system_prompt)
         else:
             if system_prompt:
-                chat_history.messages[0].insert(0, SystemMessage(content=system_prompt))
+                chat_history.messages.insert(0, SystemMessage(content=system_prompt))
     else:
         if system_prompt:
             chat_history.add_system_message(system_prompt)
 
     chat_history.add_user_message(query)
-    chat = ChatOpenAI(temperature=temperature, model_name="gpt-3.5-turbo")
+    chat_chatbot.append([query, ""])
+    # 边生成边刷新聊天框
+    async for token in astream_chat(build_context(chat_history.messages), temperature=temperature):
+        chat_chatbot[-1][1] += token
+        yield "", chat_chatbot, chat_history
+    chat_history.add_ai_message(chat_chatbot[-1][1])
+    # 超出token预算的早期轮次不会再发送，也不必继续保存
+    chat_history.messages = build_context(chat_history.messages)
+    yield "", chat_chatbot, chat_history
 
-    response = chat(chat_history.messages)
-    chat_history.add_ai_message(response.content)
-    chat_chatbot.append((query, response.content))
-    time.sleep(1)
-    return "", chat_chatbot
 
-
-def kn_chat(know_ask_input, chat_chatbot, kv_num=4, min_score=0.3):
+async def kn_chat(know_ask_input, chat_chatbot, kv_num=4, min_score=0.3, chatkn_history=None, filter=None):
+    """filter: 只从满足metadata条件的分段中检索，如 {"source": 路径} 或 {"category": "cn_Title"}"""
+    if chatkn_history is None:
+        chatkn_history = ChatMessageHistory()
     vector_store = VectorStore()
+    # 合并库可能已被API进程或后台任务进程改动
+    await asyncio.to_thread(vector_store.reload_if_changed)
     db = vector_store.db
     if db is None:
         chat_chatbot.append((know_ask_input, "请先加载或者上传知识库"))
-        return "", chat_chatbot
+        yield "", chat_chatbot, chatkn_history
+        return
+    # 会话的第一个问题与之前问过的问题足够相似、且知识库没有改动时，直接返回缓存的回答
+    version = vector_store.version
+    query_vector = await vector_store.embeddings.aembed_query(know_ask_input)
+    use_cache = len(chatkn_history.messages) == 0
+    cache_params = (kv_num, min_score, str(sorted(filter.items())) if filter else None)
+    cached = vector_store.answer_cache.get(query_vector, version, cache_params) if use_cache else None
+    if cached is not None:
+        kn_vector, answer = cached
+        chat_chatbot.append([know_ask_input, kn_vector + "\n" + answer])
+        chatkn_history.add_user_message(know_ask_input)
+        chatkn_history.add_ai_message(answer)
+        yield "", chat_chatbot, chatkn_history
+        return
+    # 检索是CPU计算和本地磁盘读取，放到线程中执行，不阻塞事件循环
     # try:
-    docs_and_scores = db.similarity_search_with_score(query=know_ask_input, k=kv_num)
+    if RETRIEVAL_MODE == "hybrid":
+        docs_and_scores = await asyncio.to_thread(vector_store.hybrid_search_with_score, know_ask_input, query_vector,
+                                                  kv_num, filter=filter)
+    else:
+        docs_and_scores = vector_store.to_similarity(await asyncio.to_thread(
+            vector_store.similarity_search_with_score_by_vector, query_vector, kv_num, filter=filter))
     # except Exception as e:
     #     info = f"数据库搜索出错，请检查是否有上传文件或所有文件已被删除,错误码:{e}"
     #     chat_chatbot.append((know_ask_input, info))
@@ -141,26 +196,30 @@ def kn_chat(know_ask_input, chat_chatbot, kv_num=4, min_score=0.3):
             kn_vector += "Score:"
             kn_vector += str(f"{score:.3f}") + "\n"
             kn_vector += "</details>"
-            kn.append(f"Document{i + 1}:doc.page_content\n")
-    query = f"""
-            Please response in Chinese,
-            I will ask you questions based on the following context:
-            - Start of Context -
-            {kn}
-            - End of Context-
-            My question is:“{know_ask_input}"
-
-            """
-    chatkn_history.add_user_message(query)
-    chat = ChatOpenAI(model_name="gpt-3.5-turbo")
-    response = chat(chatkn_history.messages)
-    chatkn_history.add_ai_message(response.content)
-    chat_chatbot.append((know_ask_input, response.content + "\n" + kn_vector))
-    time.sleep(1)
-    return "", chat_chatbot
+            kn.append(f"Document{i + 1}:{doc.page_content}\n")
+    query = build_kn_query(know_ask_input, kn)
+    # 检索到的上下文只随本轮提问发送，历史中只保存原始问题
+    messages = build_context(chatkn_history.messages + [HumanMessage(content=query)])
+    # 先展示检索到的来源，再在其后流式显示回答
+    chat_chatbot.append([know_ask_input, kn_vector])
+    yield "", chat_chatbot, chatkn_history
+    answer = ""
+    async for token in astream_chat(messages):
+        answer += token
+        chat_chatbot[-1][1] = kn_vector + "\n" + answer
+        yield "", chat_chatbot, chatkn_history
+    if use_cache:
+        vector_store.answer_cache.put(query_vector, version, cache_params, (kn_vector, answer))
+    chatkn_history.add_user_message(know_ask_input)
+    chatkn_history.add_ai_message(answer)
+    chatkn_history.messages = build_context(chatkn_history.messages)
+    yield "", chat_chatbot, chatkn_history
 
 
 with gr.Blocks() as demo:
+    # 每个会话各自的对话历史
+    chat_history = gr.State(ChatMessageHistory())
+    chatkn_history = gr.State(ChatMessageHistory())
     gr.Markdown("知识库测试")
     with gr.Tab("普通聊天模式"):
         with gr.Row():
@@ -189,22 +248,39 @@ with gr.Blocks() as demo:
                 with gr.Row():
                     vs_creat_button = gr.Button("新建或增加知识库")
                     vs_delete_button = gr.Button("删除数据库")
+                    vs_sync_button = gr.Button("同步docs目录")
                 with gr.Row():
                     vs_file_choice_dropdown = gr.Dropdown(choices=vs_file_dict,
                                                           label="删除指定文件")
                     vs_file_delete_button = gr.Button("删除指定文件")
+                job_text = gr.Textbox(label="任务状态", lines=6)
+                with gr.Row():
+                    job_id_input = gr.Number(label="任务号", precision=0)
+                    job_cancel_button = gr.Button("取消任务")
+                    job_retry_button = gr.Button("重试失败文件")
 
     with gr.Accordion("Open for More!"):
         gr.Markdown("Look at  me...")
 
-    ask_input.submit(chat, inputs=[ask_input, chatbot, text_sysprompt_input, temperature], outputs=[ask_input, chatbot])
-    know_ask_input.submit(kn_chat, inputs=[know_ask_input, chatbot_kn, kv_num, min_score],
-                          outputs=[know_ask_input, chatbot_kn])
+    ask_input.submit(chat, inputs=[ask_input, chatbot, text_sysprompt_input, temperature, chat_history],
+                     outputs=[ask_input, chatbot, chat_history])
+    know_ask_input.submit(kn_chat, inputs=[know_ask_input, chatbot_kn, kv_num, min_score, chatkn_history],
+                          outputs=[know_ask_input, chatbot_kn, chatkn_history])
+    clear.click(ChatMessageHistory, outputs=chat_history)
+    clear_kn.click(ChatMessageHistory, outputs=chatkn_history)
     vs_creat_button.click(build_vs_by_file, inputs=[docs_input, sentence_size],
                           outputs=[info_docx_text, vs_file_choice_dropdown])
+    vs_sync_button.click(sync_docs_dir, inputs=[sentence_size], outputs=[info_docx_text, vs_file_choice_dropdown])
     # 删除整个知识库
     vs_delete_button.click(delete_all_file, outputs=[info_docx_text, vs_file_choice_dropdown])
     vs_file_delete_button.click(delete_one_file, inputs=[vs_file_choice_dropdown],
                                 outputs=[info_docx_text, vs_file_choice_dropdown])
+    job_cancel_button.click(cancel_job, inputs=[job_id_input], outputs=info_docx_text)
+    job_retry_button.click(retry_job, inputs=[job_id_input], outputs=info_docx_text)
+    # 页面轮询任务状态，上传请求提交任务后立即返回
+    demo.load(poll_jobs, outputs=[job_text, vs_file_choice_dropdown], every=JOB_POLL_SECONDS)
 
-demo.launch(server_name=HOST, server_port=PORT, share=SHARE)
+# 解析进程池以forkserver/spawn方式启动时会重新导入本脚本，只在直接运行时启动任务线程和网页
+if __name__ == "__main__":
+    job_queue.start()
+    demo.queue(concurrency_count=GRADIO_CONCURRENCY).launch(server_name=HOST, server_port=PORT, share=SHARE)
@@ -1,7 +1,6 @@
 from langchain.docstore.document import Document
 import feedparser
 import html2text
-import ssl
 import time
 
 
@@ -30,8 +29,7 @@ class RSS_Url_loader:
             time.sleep(self.interval)
 
     def load(self):
-        if hasattr(ssl, '_create_unverified_context'):
-            ssl._create_default_https_context = ssl._create_unverified_context
+        # 不再全局关闭证书校验：那会让本进程所有https请求(包括LLM、embedding接口)都不校验证书
         documents = []
         for url in self.urls:
             parsed = feedparser.parse(url)
@@ -1,14 +1,34 @@
-from .image_loader import UnstructuredPaddleImageLoader
-from .pdf_loader import UnstructuredPaddlePDFLoader
+import importlib
+
 from .dialogue import (
     Person,
     Dialogue,
     Turn,
     DialogueLoader
 )
+from .registry import LoaderSpec, register_loader, sniff_mime, get_loader, load_file
+
+# PDF、图片loader依赖fitz、paddleocr、nltk，导入要数秒，第一次用到时才导入
+_LAZY_EXPORTS = {
+    "UnstructuredPaddleImageLoader": ".image_loader",
+    "UnstructuredPaddlePDFLoader": ".pdf_loader",
+}
 
 __all__ = [
     "UnstructuredPaddleImageLoader",
     "UnstructuredPaddlePDFLoader",
     "DialogueLoader",
+    "LoaderSpec",
+    "register_loader",
+    "sniff_mime",
+    "get_loader",
+    "load_file",
 ]
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
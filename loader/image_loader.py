@@ -1,10 +1,10 @@
 """Loader that loads image files."""
 from typing import List
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from paddleocr import PaddleOCR
 import os
 import nltk
 from configs.model_config import NLTK_DATA_PATH
+from .ocr import ocr_engine
 
 nltk.data.path = [NLTK_DATA_PATH] + nltk.data.path
 
@@ -18,10 +18,10 @@ class UnstructuredPaddleImageLoader(UnstructuredFileLoader):
             if not os.path.exists(full_dir_path):
                 os.makedirs(full_dir_path)
             filename = os.path.split(filepath)[-1]
-            ocr = PaddleOCR(use_angle_cls=True, lang="ch", use_gpu=False, show_log=False)
-            result = ocr.ocr(img=filepath)
+            with ocr_engine() as ocr:
+                result = ocr.ocr(img=filepath)
 
-            ocr_result = [i[1][0] for line in result for i in line]
+            ocr_result = [i[1][0] for line in result if line for i in line]
             txt_file_path = os.path.join(full_dir_path, "%s.txt" % (filename))
             with open(txt_file_path, 'w', encoding='utf-8') as fout:
                 fout.write("\n".join(ocr_result))
@@ -0,0 +1,67 @@
+"""进程内共享的PaddleOCR引擎池，PDF和图片loader共用"""
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from configs.model_config import OCR_POOL_SIZE
+
+
+class OCREnginePool:
+    """按需创建，最多size个PaddleOCR引擎；引擎都被占用时等待归还"""
+
+    def __init__(self, size: int = OCR_POOL_SIZE):
+        self.size = size
+        self._engines = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._engines.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._engines.get()
+        try:
+            # paddleocr导入很慢，第一次创建引擎时才导入
+            from paddleocr import PaddleOCR
+
+            return PaddleOCR(use_angle_cls=True, lang="ch", use_gpu=False, show_log=False)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def engine(self):
+        ocr = self._acquire()
+        try:
+            yield ocr
+        finally:
+            self._engines.put(ocr)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> OCREnginePool:
+    """每个进程一个引擎池，fork出的子进程会重新创建自己的引擎"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = OCREnginePool()
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def ocr_engine():
+    with get_ocr_pool().engine() as ocr:
+        yield ocr
@@ -1,52 +1,206 @@
 """Loader that loads image files."""
-from typing import List
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from paddleocr import PaddleOCR
+from langchain.docstore.document import Document
+from langchain.document_loaders.base import BaseLoader
+from langchain.text_splitter import TextSplitter
 import os
 import fitz
 import nltk
-from configs.model_config import NLTK_DATA_PATH
+import numpy as np
+from configs.model_config import (MP_START_METHOD, NLTK_DATA_PATH, OCR_MIN_IMAGE_SIZE, PDF_PAGE_WORKERS,
+                                  PDF_PAGES_PER_TASK, logger)
+from .ocr import ocr_engine
 
 nltk.data.path = [NLTK_DATA_PATH] + nltk.data.path
 
+# 单个PDF按页并行抽取的进程数，批量入库的子进程中会按核数调小
+page_workers = PDF_PAGE_WORKERS
 
-class UnstructuredPaddlePDFLoader(UnstructuredFileLoader):
-    """Loader that uses unstructured to load image files, such as PNGs and JPGs."""
-
-    def _get_elements(self) -> List:
-        def pdf_ocr_txt(filepath, dir_path="tmp_files"):
-            full_dir_path = os.path.join(os.path.dirname(filepath), dir_path)
-            if not os.path.exists(full_dir_path):
-                os.makedirs(full_dir_path)
-            ocr = PaddleOCR(use_angle_cls=True, lang="ch", use_gpu=False, show_log=False)
-            doc = fitz.open(filepath)
-            txt_file_path = os.path.join(full_dir_path, f"{os.path.split(filepath)[-1]}.txt")
-            img_name = os.path.join(full_dir_path, 'tmp.png')
-            with open(txt_file_path, 'w', encoding='utf-8') as fout:
-                for i in range(doc.page_count):
-                    page = doc[i]
-                    text = page.get_text("")
-                    fout.write(text)
-                    fout.write("\n")
-
-                    img_list = page.get_images()
-                    for img in img_list:
-                        pix = fitz.Pixmap(doc, img[0])
-                        if pix.n - pix.alpha >= 4:
-                            pix = fitz.Pixmap(fitz.csRGB, pix)
-                        pix.save(img_name)
-
-                        result = ocr.ocr(img_name)
-                        ocr_result = [i[1][0] for line in result for i in line]
-                        fout.write("\n".join(ocr_result))
-            if os.path.exists(img_name):
-                os.remove(img_name)
-            return txt_file_path
-
-        txt_file_path = pdf_ocr_txt(self.file_path)
-        from unstructured.partition.text import partition_text
-        return partition_text(filename=txt_file_path, **self.unstructured_kwargs)
+
+def set_page_workers(workers: int) -> None:
+    global page_workers
+    page_workers = max(1, workers)
+
+
+_page_pool = None
+# (所属进程pid, 进程数)，fork出的子进程或进程数变了时重建
+_page_pool_key = None
+_page_pool_lock = threading.Lock()
+
+
+def _init_page_worker():
+    # 页进程启动时就加载OCR引擎，之后这个进程抽取的所有PDF页共用，不再每个PDF加载一次
+    try:
+        with ocr_engine():
+            pass
+    except Exception as e:
+        logger.warning(f"OCR引擎加载失败，只抽取PDF中的文字: {e}")
+
+
+def get_page_pool(workers: int) -> ProcessPoolExecutor:
+    """本进程共用的按页抽取进程池，第一次用到时创建"""
+    global _page_pool, _page_pool_key
+    key = (os.getpid(), workers)
+    with _page_pool_lock:
+        if _page_pool_key != key:
+            if _page_pool is not None and _page_pool_key[0] == os.getpid():
+                _page_pool.shutdown(wait=False)
+            _page_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_page_worker,
+                                             mp_context=multiprocessing.get_context(MP_START_METHOD))
+            _page_pool_key = key
+        return _page_pool
+
+
+def _reset_page_pool():
+    global _page_pool_key
+    with _page_pool_lock:
+        _page_pool_key = None
+
+
+def pixmap_to_array(pix: fitz.Pixmap) -> np.ndarray:
+    """把fitz.Pixmap转成PaddleOCR可直接识别的BGR数组，不落盘"""
+    if pix.n - pix.alpha >= 4:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1:
+        img = np.repeat(img, 3, axis=2)
+    return np.ascontiguousarray(img[:, :, ::-1])
+
+
+def ocr_xrefs_by_page(doc: fitz.Document) -> Dict[int, List[int]]:
+    """
+    扫描整个文档的图片引用(不解码图片)，每个需要OCR的图片(按xref去重)只归到第一次出现的页
+    各页重复的logo、页眉图片只识别一次，不论分到哪个页区间；跳过过小的图片
+    :return: 页序号(从0开始) -> xref列表，没有图片要识别的页不出现
+    """
+    seen = set()
+    xrefs_by_page = {}
+    for i, page in enumerate(doc):
+        for img in page.get_images():
+            xref, width, height = img[0], img[2], img[3]
+            if xref in seen or min(width, height) < OCR_MIN_IMAGE_SIZE:
+                continue
+            seen.add(xref)
+            xrefs_by_page.setdefault(i, []).append(xref)
+    return xrefs_by_page
+
+
+def ocr_images(images: List[np.ndarray]) -> List[List[str]]:
+    """
+    一组图片交给同一个OCR引擎：逐张检测文字区域，所有图片的文字行裁剪后一次批量做方向分类和识别，
+    与PaddleOCR.ocr逐张调用的结果相同；没有图片时不加载引擎
+    :return: 与images一一对应的文字行列表
+    """
+    if not images:
+        return []
+    with ocr_engine() as ocr:
+        # PaddleOCR的tools包在创建引擎(导入paddleocr)后才能导入
+        from tools.infer.predict_system import sorted_boxes
+        from tools.infer.utility import get_rotate_crop_image
+
+        crops, owners = [], []
+        for n, img in enumerate(images):
+            boxes, _ = ocr.text_detector(img)
+            if boxes is None or len(boxes) == 0:
+                continue
+            for box in sorted_boxes(boxes):
+                crops.append(get_rotate_crop_image(img, box.copy()))
+                owners.append(n)
+        texts = [[] for _ in images]
+        if not crops:
+            return texts
+        if ocr.use_angle_cls:
+            crops, _, _ = ocr.text_classifier(crops)
+        results, _ = ocr.text_recognizer(crops)
+        for n, (text, score) in zip(owners, results):
+            if score >= ocr.drop_score:
+                texts[n].append(text)
+    return texts
+
+
+def extract_pages(filepath: str, start: int, end: int, xrefs_by_page: Dict[int, List[int]]) -> List[Tuple[int, str]]:
+    """
+    用独立的fitz句柄抽取[start, end)页的文字和图片OCR结果，页码从1开始
+    :param xrefs_by_page: 见ocr_xrefs_by_page，这些页中要识别的图片；整个页区间的图片一起识别
+    """
+    with fitz.open(filepath) as doc:
+        texts = [doc[i].get_text("text") for i in range(start, end)]
+        owners, images = [], []
+        for i in range(start, end):
+            for xref in xrefs_by_page.get(i, ()):
+                owners.append(i)
+                images.append(pixmap_to_array(fitz.Pixmap(doc, xref)))
+    ocr_results = {i: [] for i in range(start, end)}
+    for i, lines in zip(owners, ocr_images(images)):
+        ocr_results[i].extend(lines)
+    return [(i + 1, text + "\n" + "\n".join(ocr_results[i])) for i, text in zip(range(start, end), texts)]
+
+
+def iter_pdf_pages(filepath: str, workers: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    """
+    按页码顺序逐页产出 (页码, 文本)
+    页数较多时把页区间分给多个进程并行抽取，前面的区间完成后立即产出，不必等最后一页
+    """
+    workers = workers or page_workers
+    with fitz.open(filepath) as doc:
+        page_count = doc.page_count
+        xrefs_by_page = ocr_xrefs_by_page(doc)
+    if workers <= 1 or page_count <= PDF_PAGES_PER_TASK:
+        for start in range(0, page_count, PDF_PAGES_PER_TASK):
+            yield from extract_pages(filepath, start, min(start + PDF_PAGES_PER_TASK, page_count), xrefs_by_page)
+        return
+    pool = get_page_pool(workers)
+    futures = []
+    for start in range(0, page_count, PDF_PAGES_PER_TASK):
+        end = min(start + PDF_PAGES_PER_TASK, page_count)
+        task_xrefs = {i: xrefs for i, xrefs in xrefs_by_page.items() if start <= i < end}
+        futures.append(pool.submit(extract_pages, filepath, start, end, task_xrefs))
+    try:
+        for future in futures:
+            yield from future.result()
+    except BrokenProcessPool:
+        # 页进程异常退出后进程池不能再用，下一个PDF重建
+        _reset_page_pool()
+        raise
+    finally:
+        # 提前停止读取(出错、取消)时，还没开始的页区间不再抽取
+        for future in futures:
+            future.cancel()
+
+
+class UnstructuredPaddlePDFLoader(BaseLoader):
+    """Loader that uses PyMuPDF and PaddleOCR to load PDF files page by page."""
+
+    def __init__(self, file_path: str, mode: str = "single", **unstructured_kwargs):
+        # 不再经过unstructured解析，mode等参数只为兼容旧的调用方式
+        self.file_path = file_path
+        self.mode = mode
+        self.unstructured_kwargs = unstructured_kwargs
+
+    def lazy_load(self) -> Iterator[Document]:
+        for page_number, text in iter_pdf_pages(self.file_path):
+            if text.strip():
+                yield Document(page_content=text, metadata={"source": self.file_path, "page": page_number})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+    def lazy_load_and_split(self, text_splitter: TextSplitter) -> Iterator[Document]:
+        """每抽取完一页就切分产出，不再生成中间txt文件"""
+        for doc in self.lazy_load():
+            yield from text_splitter.split_documents([doc])
+
+    def load_and_split(self, text_splitter: Optional[TextSplitter] = None) -> List[Document]:
+        if text_splitter is None:
+            return self.load()
+        return list(self.lazy_load_and_split(text_splitter))
 
 
 if __name__ == "__main__":
@@ -55,7 +209,7 @@ if __name__ == "__main__":
     sys.path.append(os.path.dirname(os.path.dirname(__file__)))
     filepath = os.path.join(os.path.dirname(os.path.dirname(__file__)), "knowledge_base", "samples", "content",
                             "test.pdf")
-    loader = UnstructuredPaddlePDFLoader(filepath, mode="elements")
+    loader = UnstructuredPaddlePDFLoader(filepath)
     docs = loader.load()
     for doc in docs:
         print(doc)
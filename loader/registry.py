@@ -0,0 +1,179 @@
+"""
+按文件头嗅探的MIME类型和扩展名选择loader
+每种格式声明解析开销：light(纯文本类)、heavy(OCR)、network(需要联网)，批量入库时按开销分到不同的线程池、进程池
+新增格式用 @register_loader(...) 注册一个 (filepath, sentence_size) -> List[Document] 的函数即可
+"""
+import mimetypes
+import os
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from langchain.docstore.document import Document
+from configs.model_config import RSS_ALLOWED_HOSTS
+from textsplitter import ChineseTextSplitter
+
+COST_LIGHT = "light"
+COST_HEAVY = "heavy"
+COST_NETWORK = "network"
+COST_CLASSES = (COST_LIGHT, COST_HEAVY, COST_NETWORK)
+# 嗅探时读取的文件头字节数
+SNIFF_BYTES = 512
+# 文件头 -> MIME类型，扩展名缺失或错误时以它为准
+_MAGIC = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+]
+
+
+class LoaderSpec(NamedTuple):
+    name: str
+    load: Callable[[str, int], List[Document]]
+    cost: str
+    extensions: Tuple[str, ...]
+    mime_types: Tuple[str, ...]
+
+
+_by_extension: Dict[str, LoaderSpec] = {}
+_by_mime: Dict[str, LoaderSpec] = {}
+
+
+def register_loader(extensions=(), mime_types=(), cost=COST_LIGHT):
+    """注册loader函数，扩展名带点、不区分大小写；与已注册的扩展名、MIME类型重复时覆盖"""
+    if cost not in COST_CLASSES:
+        raise ValueError(f"未知的解析开销{cost}，可选{COST_CLASSES}")
+
+    def decorator(load):
+        spec = LoaderSpec(load.__name__, load, cost, tuple(ext.lower() for ext in extensions), tuple(mime_types))
+        for ext in spec.extensions:
+            _by_extension[ext] = spec
+        for mime in spec.mime_types:
+            _by_mime[mime] = spec
+        return load
+
+    return decorator
+
+
+def sniff_mime(filepath) -> Optional[str]:
+    """按文件头识别的MIME类型，识别不了(包括各种纯文本)时为None"""
+    try:
+        with open(filepath, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return None
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if head.startswith((b"<?xml", b"<rss", b"<feed")):
+        if b"<rss" in head:
+            return "application/rss+xml"
+        if b"<feed" in head:
+            return "application/atom+xml"
+    return None
+
+
+def get_loader(filepath) -> LoaderSpec:
+    """依次按文件头、扩展名、由扩展名猜测的MIME类型查找，都不认识的交给unstructured"""
+    spec = _by_mime.get(sniff_mime(filepath))
+    if spec is None:
+        spec = _by_extension.get(os.path.splitext(filepath)[1].lower())
+    if spec is None:
+        spec = _by_mime.get(mimetypes.guess_type(filepath)[0])
+    return spec or _UNSTRUCTURED
+
+
+def load_file(filepath, sentence_size=100) -> List[Document]:
+    return get_loader(filepath).load(filepath, sentence_size)
+
+
+def _set_source(docs, filepath):
+    # 合并库按metadata["source"]记录、过滤和删除文件
+    for doc in docs:
+        doc.metadata["source"] = filepath
+    return docs
+
+
+# 各格式依赖的库在用到时才导入，见benchmarks/import_time.py
+
+@register_loader([".txt"], ["text/plain"])
+def load_text(filepath, sentence_size):
+    from langchain.document_loaders import TextLoader
+
+    return TextLoader(filepath).load_and_split(ChineseTextSplitter(pdf=False, sentence_size=sentence_size))
+
+
+@register_loader([".md"], ["text/markdown"])
+def load_markdown(filepath, sentence_size):
+    from langchain.document_loaders import UnstructuredFileLoader
+
+    return UnstructuredFileLoader(filepath, mode="elements").load()
+
+
+@register_loader([".csv"], ["text/csv"])
+def load_csv(filepath, sentence_size):
+    from langchain.document_loaders import CSVLoader
+
+    return CSVLoader(filepath).load()
+
+
+@register_loader([".pdf"], ["application/pdf"], cost=COST_HEAVY)
+def load_pdf(filepath, sentence_size):
+    from .pdf_loader import UnstructuredPaddlePDFLoader
+
+    return UnstructuredPaddlePDFLoader(filepath).load_and_split(ChineseTextSplitter(pdf=True,
+                                                                                    sentence_size=sentence_size))
+
+
+@register_loader([".jpg", ".jpeg", ".png"], ["image/jpeg", "image/png"], cost=COST_HEAVY)
+def load_image(filepath, sentence_size):
+    from .image_loader import UnstructuredPaddleImageLoader
+
+    loader = UnstructuredPaddleImageLoader(filepath, mode="elements")
+    return loader.load_and_split(text_splitter=ChineseTextSplitter(pdf=False, sentence_size=sentence_size))
+
+
+@register_loader([".dialogue"])
+def load_dialogue(filepath, sentence_size):
+    """对话记录，格式见loader.dialogue.Dialogue.parse_dialogue，每轮发言一个分段，过长的再切分"""
+    from .dialogue import DialogueLoader
+
+    loader = DialogueLoader(filepath)
+    docs = loader.load()
+    for doc, turn in zip(docs, loader.dialogue.turns):
+        doc.metadata = {"source": filepath, "speaker": turn.speaker.name}
+    return ChineseTextSplitter(pdf=False, sentence_size=sentence_size).split_documents(docs)
+
+
+@register_loader([".rss", ".atom"], ["application/rss+xml", "application/atom+xml"])
+def load_feed(filepath, sentence_size):
+    """保存在本地的RSS/Atom订阅源文件，每个条目一个文档"""
+    from .RSS_loader import RSS_Url_loader
+
+    docs = RSS_Url_loader(filepath).load()
+    return ChineseTextSplitter(pdf=False, sentence_size=sentence_size).split_documents(_set_source(docs, filepath))
+
+
+@register_loader([".feeds"], cost=COST_NETWORK)
+def load_feed_urls(filepath, sentence_size):
+    """每行一个订阅源URL，入库时在线拉取全部条目；只拉取RSS_ALLOWED_HOSTS中的主机"""
+    from urllib.parse import urlsplit
+    from .RSS_loader import RSS_Url_loader
+
+    with open(filepath, encoding="utf-8") as f:
+        urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    for url in urls:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or parts.hostname not in RSS_ALLOWED_HOSTS:
+            raise ValueError(f"订阅源{url}的主机不在RSS_ALLOWED_HOSTS中，不拉取")
+    docs = RSS_Url_loader(urls).load()
+    return ChineseTextSplitter(pdf=False, sentence_size=sentence_size).split_documents(_set_source(docs, filepath))
+
+
+def load_unstructured(filepath, sentence_size):
+    from langchain.document_loaders import UnstructuredFileLoader
+
+    loader = UnstructuredFileLoader(filepath, mode="elements")
+    return loader.load_and_split(text_splitter=ChineseTextSplitter(pdf=False, sentence_size=sentence_size))
+
+
+_UNSTRUCTURED = LoaderSpec("load_unstructured", load_unstructured, COST_LIGHT, (), ())
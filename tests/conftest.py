@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.utils as vs_module  # noqa: E402
+
+DIM = 32
+
+
+class HashEmbeddings(Embeddings):
+    """按字符哈希到固定维度的归一化向量，不请求接口；字符重合越多的文本越相近"""
+
+    def _embed(self, text):
+        vector = np.zeros(DIM, dtype=np.float32)
+        for char in text:
+            vector[hashlib.md5(char.encode("utf-8")).digest()[0] % DIM] += 1
+        return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+@pytest.fixture
+def vs_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(vs_module, "VS_ROOT_PATH", str(tmp_path))
+    monkeypatch.setattr(vs_module, "VS_RELOAD_CHECK_SECONDS", 0)
+    # 默认不自动压缩，需要压缩的用例自己调低
+    monkeypatch.setattr(vs_module, "VS_COMPACT_RATIO", 1.0)
+    return tmp_path
+
+
+@pytest.fixture
+def new_store(vs_root):
+    """每次调用返回一个新的VectorStore实例，相当于一个新启动的进程"""
+    cls = type(vs_module.VectorStore())
+
+    def create():
+        store = cls()
+        store.embeddings = HashEmbeddings()
+        store.load_knowledge_base()
+        return store
+
+    return create
+
+
+@pytest.fixture
+def make_item(vs_root):
+    """写入文件name.txt，返回add_embedded_documents的一项 (source, documents, vectors)"""
+    embeddings = HashEmbeddings()
+    os.makedirs(os.path.join(str(vs_root), "docs"), exist_ok=True)
+
+    def make(name, texts):
+        source = os.path.join(str(vs_root), "docs", f"{name}.txt")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write("\n".join(texts))
+        docs = [Document(page_content=text, metadata={"source": source}) for text in texts]
+        return name, docs, embeddings.embed_documents(texts)
+
+    return make
@@ -0,0 +1,157 @@
+import os
+
+import pytest
+
+import utils.utils as vs_module
+from tests.conftest import HashEmbeddings
+
+
+def texts(name, n):
+    return [f"{name}文件第{i}段 内容{name * (i + 1)}" for i in range(n)]
+
+
+def contents(docs_and_scores):
+    return [doc.page_content for doc, _ in docs_and_scores]
+
+
+def search(store, query, k=4, filter=None):
+    return store.similarity_search_with_score(query, k=k, filter=filter)
+
+
+def test_reupload_tombstones_old_chunks(new_store, make_item):
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 3)), make_item("b", texts("b", 3))])
+    assert store.catalog.sources["a.txt"]["ranges"] == [[0, 3]]
+
+    store.add_embedded_documents([make_item("a", ["a文件新版本"])])
+
+    assert store.snapshot.tombstones == {0, 1, 2}
+    assert store.catalog.sources["a.txt"]["ranges"] == [[6, 7]]
+    assert store.snapshot.db.index.ntotal == 7
+    hits = contents(search(store, "a文件第0段", k=7))
+    assert len(hits) == 4
+    assert not set(hits) & set(texts("a", 3))
+    assert "a文件新版本" in hits
+    hybrid = store.hybrid_search_with_score("a文件第0段", HashEmbeddings().embed_query("a文件第0段"), k=7)
+    assert not set(contents(hybrid)) & set(texts("a", 3))
+
+
+def test_compaction_past_ratio(new_store, make_item, monkeypatch):
+    monkeypatch.setattr(vs_module, "VS_COMPACT_RATIO", 0.3)
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 2)), make_item("b", texts("b", 8))])
+    chunks_file = store._manifest["chunks"]
+
+    # 2/10没有超过压缩比例，只打墓碑
+    store.delete_vector_stores(["a.txt"])
+    assert store.snapshot.tombstones == {0, 1}
+    assert store.snapshot.db.index.ntotal == 10
+
+    # 再重传b：10个位置里有10个墓碑，超过比例后压缩
+    store.add_embedded_documents([make_item("b", texts("b", 4))])
+    assert store.snapshot.tombstones == frozenset()
+    assert store.snapshot.db.index.ntotal == 4
+    assert len(store.chunks) == 4
+    assert store._manifest["chunks"] != chunks_file
+    assert store.catalog.sources["b.txt"]["ranges"] == [[0, 4]]
+    assert sorted(contents(search(store, "b文件第0段", k=10))) == sorted(texts("b", 4))
+
+    # 压缩后的一代重启后仍能读出
+    assert sorted(contents(search(new_store(), "b文件第0段", k=10))) == sorted(texts("b", 4))
+
+    # 压缩前的分段存储保留到下一次提交，供其他进程在重新加载前继续读
+    assert os.path.exists(os.path.join(store.old_db_path, chunks_file))
+    store.add_embedded_documents([make_item("c", texts("c", 1))])
+    assert not os.path.exists(os.path.join(store.old_db_path, chunks_file))
+
+
+def test_rollback_after_failed_add(new_store, make_item):
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 3))])
+    snapshot = store.snapshot
+    manifest = store._manifest
+
+    name, docs, vectors = make_item("c", ["维度不对的分段"])
+    bad = (name, docs, [vector + [0.0] for vector in vectors])
+    with pytest.raises(Exception):
+        # 同一批里a被重传，整批失败后a的旧版本不能被删
+        store.add_embedded_documents([make_item("a", ["a文件新版本"]), bad])
+
+    assert store.snapshot is snapshot
+    assert store._manifest == manifest
+    assert store.tombstones == set()
+    assert len(store.chunks) == 3
+    assert set(store.catalog.sources) == {"a.txt"}
+    assert store.catalog.sources["a.txt"]["ranges"] == [[0, 3]]
+    assert sorted(contents(search(store, "a文件第0段"))) == sorted(texts("a", 3))
+
+    # 回滚后可以继续写入
+    store.add_embedded_documents([make_item("c", texts("c", 2))])
+    assert store.catalog.sources["c.txt"]["ranges"] == [[3, 5]]
+    assert len(store.chunks) == 5
+    assert sorted(new_store().get_docs_dict()) == ["a.txt", "c.txt"]
+
+
+def test_rollback_when_manifest_switch_fails(new_store, make_item, monkeypatch):
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 3))])
+    manifest = store._manifest
+    replace = os.replace
+
+    def fail_on_manifest(src, dst):
+        if os.path.basename(dst) == vs_module.MANIFEST_FILE:
+            raise OSError("disk full")
+        replace(src, dst)
+
+    monkeypatch.setattr(vs_module.os, "replace", fail_on_manifest)
+    with pytest.raises(OSError):
+        store.add_embedded_documents([make_item("a", ["a文件新版本"])])
+    monkeypatch.setattr(vs_module.os, "replace", replace)
+
+    assert store._manifest == manifest
+    assert store.tombstones == set()
+    assert len(store.chunks) == 3
+    restarted = new_store()
+    assert restarted._manifest == manifest
+    assert restarted.snapshot.tombstones == frozenset()
+    assert sorted(contents(search(restarted, "a文件第0段"))) == sorted(texts("a", 3))
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_filtered_search_returns_k_hits(new_store, make_item, vs_root, hybrid):
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 6)), make_item("b", texts("b", 20))])
+    store.add_embedded_documents([make_item("a", texts("a", 6))])
+    assert len(store.snapshot.tombstones) == 6
+
+    # 过滤条件只选中a的6个分段，与问题最相近的都是b的分段
+    query = "b文件第0段 内容b"
+    source = os.path.join(str(vs_root), "docs", "a.txt")
+    if hybrid:
+        hits = store.hybrid_search_with_score(query, HashEmbeddings().embed_query(query), k=5,
+                                              filter={"source": source})
+    else:
+        hits = search(store, query, k=5, filter={"source": source})
+    assert len(hits) == 5
+    assert all(doc.metadata["source"] == source for doc, _ in hits)
+
+
+def test_reload_after_restart(new_store, make_item):
+    store = new_store()
+    store.add_embedded_documents([make_item("a", texts("a", 3)), make_item("b", texts("b", 3))])
+    store.delete_vector_stores(["a.txt"])
+    expected = search(store, "a文件第0段", k=6)
+
+    restarted = new_store()
+    assert restarted.get_docs_dict() == store.get_docs_dict()
+    assert restarted.snapshot.tombstones == {0, 1, 2}
+    assert restarted.snapshot.generation == store.snapshot.generation
+    assert contents(search(restarted, "a文件第0段", k=6)) == contents(expected)
+    assert sorted(contents(expected)) == sorted(texts("b", 3))
+
+    # 另一个进程提交后，按磁盘文件的变化重新加载
+    store.add_embedded_documents([make_item("c", texts("c", 2))])
+    assert restarted.reload_if_changed(force=True)
+    assert sorted(restarted.get_docs_dict()) == ["b.txt", "c.txt"]
+    assert restarted.snapshot.tombstones == {0, 1, 2}
+    assert not restarted.reload_if_changed(force=True)
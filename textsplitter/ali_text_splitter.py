@@ -1,8 +1,20 @@
 from langchain.text_splitter import CharacterTextSplitter
+import functools
 import re
 from typing import List
 
 
+@functools.lru_cache(maxsize=None)
+def segmentation_pipeline():
+    """文档语义切分模型，第一次切分时才导入modelscope并加载，之后每次切分复用"""
+    from modelscope.pipelines import pipeline
+
+    return pipeline(
+        task="document-segmentation",
+        model='damo/nlp_bert_document-segmentation_chinese-base',
+        device="cpu")
+
+
 class AliTextSplitter(CharacterTextSplitter):
     def __init__(self, pdf: bool = False, **kwargs):
         super().__init__(**kwargs)
@@ -17,12 +29,6 @@ class AliTextSplitter(CharacterTextSplitter):
             text = re.sub(r"\n{3,}", r"\n", text)
             text = re.sub('\s', " ", text)
             text = re.sub("\n\n", "", text)
-        from modelscope.pipelines import pipeline
-
-        p = pipeline(
-            task="document-segmentation",
-            model='damo/nlp_bert_document-segmentation_chinese-base',
-            device="cpu")
-        result = p(documents=text)
+        result = segmentation_pipeline()(documents=text)
         sent_list = [i for i in result["text"].split("\n\t") if i]
         return sent_list
@@ -1,8 +1,21 @@
 from langchain.text_splitter import CharacterTextSplitter
 import re
-from typing import List
+from typing import Iterator, List
 from configs.model_config import SENTENCE_SIZE
 
+PDF_NEWLINES_RE = re.compile(r"\n{3,}")
+WHITESPACE_RE = re.compile(r"\s")
+SENTENCE_END_RE = re.compile(r'([;；.!?。！？\?])([^”’])')
+EN_ELLIPSIS_RE = re.compile(r'(\.{6})([^"’”」』])')
+ZH_ELLIPSIS_RE = re.compile(r'(\…{2})([^"’”」』])')
+QUOTE_END_RE = re.compile(r'([;；!?。！？\?]["’”」』]{0,2})([^;；!?，。！？\?])')
+# 超长句子逐级再切分的规则：逗号、连续空格、单个空格
+LONG_SENTENCE_RES = (
+    re.compile(r'([,，.]["’”」』]{0,2})([^,，.])'),
+    re.compile(r'([\n]{1,}| {2,}["’”」』]{0,2})([^\s])'),
+    re.compile(r'( ["’”」』]{0,2})([^ ])'),
+)
+
 
 class ChineseTextSplitter(CharacterTextSplitter):
     def __init__(self, pdf: bool = False, sentence_size: int = SENTENCE_SIZE, **kwargs):
@@ -24,37 +37,31 @@ class ChineseTextSplitter(CharacterTextSplitter):
                 sent_list.append(ele)
         return sent_list
 
-    def split_text(self, text: str) -> List[str]:   ##此处需要进一步优化逻辑
+    def split_text(self, text: str) -> List[str]:
+        return list(self.iter_split_text(text))
+
+    def iter_split_text(self, text: str) -> Iterator[str]:
+        """逐句产出，每个字符在每一级规则中只处理一次，整体为线性时间"""
         if self.pdf:
-            text = re.sub(r"\n{3,}", r"\n", text)
-            text = re.sub('\s', " ", text)
-            text = re.sub("\n\n", "", text)
-
-        text = re.sub(r'([;；.!?。！？\?])([^”’])', r"\1\n\2", text)  # 单字符断句符
-        text = re.sub(r'(\.{6})([^"’”」』])', r"\1\n\2", text)  # 英文省略号
-        text = re.sub(r'(\…{2})([^"’”」』])', r"\1\n\2", text)  # 中文省略号
-        text = re.sub(r'([;；!?。！？\?]["’”」』]{0,2})([^;；!?，。！？\?])', r'\1\n\2', text)
+            text = PDF_NEWLINES_RE.sub("\n", text)
+            text = WHITESPACE_RE.sub(" ", text)
+            text = text.replace("\n\n", "")
+
+        text = SENTENCE_END_RE.sub(r"\1\n\2", text)  # 单字符断句符
+        text = EN_ELLIPSIS_RE.sub(r"\1\n\2", text)  # 英文省略号
+        text = ZH_ELLIPSIS_RE.sub(r"\1\n\2", text)  # 中文省略号
+        text = QUOTE_END_RE.sub(r"\1\n\2", text)
         # 如果双引号前有终止符，那么双引号才是句子的终点，把分句符\n放到双引号后，注意前面的几句都小心保留了双引号
         text = text.rstrip()  # 段尾如果有多余的\n就去掉它
         # 很多规则中会考虑分号;，但是这里我把它忽略不计，破折号、英文双引号等同样忽略，需要的再做些简单调整即可。
-        ls = [i for i in text.split("\n") if i]
-        for ele in ls:
-            if len(ele) > self.sentence_size:
-                ele1 = re.sub(r'([,，.]["’”」』]{0,2})([^,，.])', r'\1\n\2', ele)
-                ele1_ls = ele1.split("\n")
-                for ele_ele1 in ele1_ls:
-                    if len(ele_ele1) > self.sentence_size:
-                        ele_ele2 = re.sub(r'([\n]{1,}| {2,}["’”」』]{0,2})([^\s])', r'\1\n\2', ele_ele1)
-                        ele2_ls = ele_ele2.split("\n")
-                        for ele_ele2 in ele2_ls:
-                            if len(ele_ele2) > self.sentence_size:
-                                ele_ele3 = re.sub('( ["’”」』]{0,2})([^ ])', r'\1\n\2', ele_ele2)
-                                ele2_id = ele2_ls.index(ele_ele2)
-                                ele2_ls = ele2_ls[:ele2_id] + [i for i in ele_ele3.split("\n") if i] + ele2_ls[
-                                                                                                       ele2_id + 1:]
-                        ele_id = ele1_ls.index(ele_ele1)
-                        ele1_ls = ele1_ls[:ele_id] + [i for i in ele2_ls if i] + ele1_ls[ele_id + 1:]
-
-                id = ls.index(ele)
-                ls = ls[:id] + [i for i in ele1_ls if i] + ls[id + 1:]
-        return ls
+        for sentence in text.split("\n"):
+            yield from self._split_long_sentence(sentence, 0)
+
+    def _split_long_sentence(self, sentence: str, level: int) -> Iterator[str]:
+        """超长的句子依次按 逗号、连续空格、单个空格 再切分，最后一级切出的片段不论长短都保留"""
+        if len(sentence) <= self.sentence_size or level == len(LONG_SENTENCE_RES):
+            if sentence:
+                yield sentence
+            return
+        for piece in LONG_SENTENCE_RES[level].sub(r"\1\n\2", sentence).split("\n"):
+            yield from self._split_long_sentence(piece, level + 1)
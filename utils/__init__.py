@@ -1,4 +1,26 @@
-from .utils import singleton, torch_gc, get_pinyin, ChatMessageHistory, load_file, VectorStore
-from .MyFAISS import MyFAISS
+"""
+子模块在第一次访问其中的名字时才导入：import utils.utils 不会连带导入openai、tiktoken、任务队列等
+"""
+import importlib
 
-__all__ = ["singleton", "torch_gc", "get_pinyin", "ChatMessageHistory", "load_file", "VectorStore", "MyFAISS"]
+# 名字 -> 所在子模块
+_EXPORTS = {
+    "singleton": ".utils", "torch_gc": ".utils", "get_pinyin": ".utils", "ChatMessageHistory": ".utils",
+    "load_file": ".utils", "VectorStore": ".utils", "MyFAISS": ".MyFAISS",
+    "CachedEmbeddings": ".embeddings", "get_embeddings": ".embeddings", "ingest_files": ".ingest",
+    "embed_texts": ".ingest", "sync_docs": ".sync", "JobQueue": ".jobs", "astream_chat": ".chat",
+    "build_context": ".chat", "build_kn_query": ".chat", "LLMClient": ".llm_client",
+    "OpenAIClientEmbeddings": ".llm_client", "get_llm_client": ".llm_client",
+}
+
+__all__ = ["singleton", "torch_gc", "get_pinyin", "ChatMessageHistory", "load_file", "VectorStore", "MyFAISS",
+           "CachedEmbeddings", "get_embeddings", "ingest_files", "embed_texts", "sync_docs", "JobQueue",
+           "astream_chat", "build_context", "build_kn_query", "LLMClient", "OpenAIClientEmbeddings", "get_llm_client"]
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,67 @@
+import functools
+from typing import AsyncIterator, List
+
+import tiktoken
+from langchain.schema import AIMessage, BaseMessage, SystemMessage
+
+from configs.model_config import CHAT_MODEL, CHAT_HISTORY_TOKEN_BUDGET
+
+
+async def astream_chat(messages: List[BaseMessage], temperature: float = 0.7,
+                       model_name: str = CHAT_MODEL) -> AsyncIterator[str]:
+    """通过共享的LLMClient流式调用聊天模型，边生成边产出token"""
+    # openai、aiohttp导入要数百毫秒，第一次调用时才导入
+    from .llm_client import get_llm_client
+
+    async for token in get_llm_client().astream_chat(messages, temperature=temperature, model_name=model_name):
+        yield token
+
+
+def build_kn_query(question: str, contexts: List[str]) -> str:
+    """知识库问答本轮发给模型的提问：检索到的分段作为上下文，后面附上原始问题"""
+    return f"""
+            Please response in Chinese,
+            I will ask you questions based on the following context:
+            - Start of Context -
+            {"".join(contexts)}
+            - End of Context-
+            My question is:“{question}"
+
+            """
+
+
+@functools.lru_cache()
+def _encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(message: BaseMessage, model_name: str = CHAT_MODEL) -> int:
+    # 每条消息另有约4个token的格式开销
+    return len(_encoding(model_name).encode(message.content)) + 4
+
+
+def build_context(messages: List[BaseMessage], max_tokens: int = CHAT_HISTORY_TOKEN_BUDGET,
+                  model_name: str = CHAT_MODEL) -> List[BaseMessage]:
+    """
+    按token预算裁剪对话历史：始终保留开头的系统提示和最后一条消息，
+    其余消息从新到旧依次保留，放不下的早期轮次丢弃
+    """
+    system = [message for message in messages[:1] if isinstance(message, SystemMessage)]
+    rest = messages[len(system):]
+    if not rest:
+        return system
+    budget = max_tokens - sum(count_tokens(message, model_name) for message in system + rest[-1:])
+    kept = []
+    for message in reversed(rest[:-1]):
+        budget -= count_tokens(message, model_name)
+        if budget < 0:
+            break
+        kept.append(message)
+    kept.reverse()
+    # 不以没有对应提问的回答开头
+    while kept and isinstance(kept[0], AIMessage):
+        kept.pop(0)
+    return system + kept + rest[-1:]
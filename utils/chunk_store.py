@@ -0,0 +1,314 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from langchain.docstore.document import Document
+
+from configs.model_config import CHUNK_STORE_MMAP_SIZE, LEXICAL_MAX_DF_RATIO, LEXICAL_MIN_MAX_DF
+from .lexical import tokenize, fts_query
+from .query_cache import LRUCache
+
+# 单独成列的metadata，其余的键存为json
+COLUMNS = ("page", "category")
+# 关键词倒排索引：FTS5只保存分词结果不保存原文(原文在chunks表)，rowid即向量位置
+# 分词在写入前由tokenize完成，词之间用空格分隔；tokenchars保留编号中的 - _ .
+FTS_DDL = "CREATE VIRTUAL TABLE chunks_fts USING fts5(tokens, content='', tokenize=\"unicode61 tokenchars '-_.'\")"
+# 每个词出现在多少个分段中(文档频率)
+FTS_VOCAB_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts_vocab USING fts5vocab(chunks_fts, 'row')"
+# 缓存的文档频率条数，fts5vocab统计高频词要遍历整个倒排列表
+DF_CACHE_SIZE = 100000
+
+
+class ChunkStore:
+    """
+    合并库分段的SQLite存储，代替随每次save_local整体pickle的docstore
+    主键即向量位置；正文、来源、页码、类别各占一列，来源路径单独成表只存一次，其余metadata存为json
+    写入只追加新行，耗时与新增分段数成正比；检索时只按主键读出命中的k行
+    同一个库里维护分段的关键词倒排索引(chunks_fts)，随分段一起增量写入
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._source_ids = None
+        self._lock = threading.Lock()
+        self._df_cache = LRUCache(DF_CACHE_SIZE)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        # 首次读写时才打开，只加载不查询的库不会创建文件
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL下多个进程可以同时读；mmap_size让各进程共享页缓存
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA mmap_size={CHUNK_STORE_MMAP_SIZE}")
+            conn.execute("CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, path TEXT UNIQUE)")
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT, "
+                         "source_id INTEGER, page INTEGER, category TEXT, extra TEXT)")
+            # 已删除的分段及删除它的那一代(见VectorStore._save_generation)，第g代的快照只跳过generation<=g的
+            conn.execute("CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY, generation INTEGER)")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is None:
+                # 上一版本的分段存储没有倒排索引，补建一次
+                conn.execute(FTS_DDL)
+                self._rebuild_fts(conn)
+            conn.execute(FTS_VOCAB_DDL)
+            conn.commit()
+            self._conn = conn
+            self._source_ids = dict((path, i) for i, path in conn.execute("SELECT id, path FROM sources"))
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @classmethod
+    def from_documents(cls, path, documents: Iterable[Document], batch_size=10000):
+        """旧版本的知识库只有pickle的docstore，按向量位置顺序导出"""
+        store = cls(path)
+        batch = []
+        start = 0
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                store.append(batch, start)
+                start += len(batch)
+                batch = []
+        store.append(batch, start)
+        return store
+
+    def __len__(self):
+        with self._lock:
+            # 主键连续，取最大值比COUNT(*)全表扫描快
+            return self._connect().execute("SELECT COALESCE(MAX(id) + 1, 0) FROM chunks").fetchone()[0]
+
+    def _source_id(self, conn, path):
+        if path not in self._source_ids:
+            self._source_ids[path] = conn.execute("INSERT INTO sources (path) VALUES (?)", (path,)).lastrowid
+        return self._source_ids[path]
+
+    def append(self, documents: List[Document], start: int):
+        """写入位置从start开始的一批分段"""
+        if not documents:
+            return
+        with self._lock:
+            conn = self._connect()
+            rows = []
+            for i, doc in enumerate(documents, start):
+                metadata = dict(doc.metadata)
+                source_id = self._source_id(conn, metadata.pop("source", None))
+                page, category = (metadata.pop(key, None) for key in COLUMNS)
+                extra = json.dumps(metadata, ensure_ascii=False) if metadata else None
+                rows.append((i, doc.page_content, source_id, page, category, extra))
+            conn.executemany("INSERT INTO chunks (id, text, source_id, page, category, extra) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany("INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)",
+                             ((row[0], " ".join(tokenize(row[1]))) for row in rows))
+            conn.commit()
+            self._df_cache.clear()
+
+    @staticmethod
+    def _document(row) -> Document:
+        text, source, page, category, extra = row
+        metadata = {"source": source}
+        if page is not None:
+            metadata["page"] = page
+        if category is not None:
+            metadata["category"] = category
+        if extra:
+            metadata.update(json.loads(extra))
+        return Document(page_content=text, metadata=metadata)
+
+    _SELECT = "SELECT chunks.id, text, sources.path, page, category, extra FROM chunks " \
+              "LEFT JOIN sources ON sources.id = chunks.source_id"
+
+    def get(self, ids: List[int]) -> List[Document]:
+        """按向量位置取分段，返回顺序与ids一致"""
+        if not ids:
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                f"{self._SELECT} WHERE chunks.id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        found = {row[0]: self._document(row[1:]) for row in rows}
+        return [found[i] for i in ids]
+
+    def iter_documents(self, batch_size=10000) -> Iterator[Document]:
+        """按位置顺序分批读出全部分段"""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._connect().execute(f"{self._SELECT} WHERE chunks.id > ? ORDER BY chunks.id LIMIT ?",
+                                               (last, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._document(row[1:])
+            last = rows[-1][0]
+
+    @staticmethod
+    def _filter_sql(filter: dict) -> Tuple[str, list]:
+        """
+        metadata过滤条件对应的子查询，选出满足条件的分段主键
+        filter: {键: 值或值的列表}，各键之间为且；source、page、category直接查列，其余键查json中的字段
+        """
+        clauses, params = [], []
+        for key, value in filter.items():
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            if key == "source":
+                column = "sources.path"
+            elif key in COLUMNS:
+                column = f"chunks.{key}"
+            else:
+                column = "json_extract(chunks.extra, ?)"
+                params.append(f'$."{key}"')
+            clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+        where = " AND ".join(clauses) or "1"
+        return f"SELECT chunks.id FROM chunks LEFT JOIN sources ON sources.id = chunks.source_id WHERE {where}", params
+
+    def filter_ids(self, filter: dict) -> List[int]:
+        """按metadata过滤，返回满足条件的向量位置，条件写法见_filter_sql"""
+        sql, params = self._filter_sql(filter)
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [row[0] for row in rows]
+
+    def truncate(self, size: int):
+        """丢弃位置>=size的分段，用于索引保存前进程退出导致分段比向量多的情况"""
+        with self._lock:
+            conn = self._connect()
+            # 倒排索引不保存原文，删除时要用同样的分词结果
+            rows = conn.execute("SELECT id, text FROM chunks WHERE id >= ?", (size,)).fetchall()
+            conn.executemany("INSERT INTO chunks_fts (chunks_fts, rowid, tokens) VALUES ('delete', ?, ?)",
+                             ((i, " ".join(tokenize(text))) for i, text in rows))
+            conn.execute("DELETE FROM chunks WHERE id >= ?", (size,))
+            conn.commit()
+            self._df_cache.clear()
+
+    def add_tombstones(self, ids: Iterable[int], generation: int):
+        """记录第generation代删除的分段，之前的代已经记录过的保持不变"""
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR IGNORE INTO tombstones (id, generation) VALUES (?, ?)",
+                             ((i, generation) for i in ids))
+            conn.commit()
+
+    def tombstones(self, generation: int) -> Set[int]:
+        """第generation代及之前删除的分段位置"""
+        with self._lock:
+            rows = self._connect().execute("SELECT id FROM tombstones WHERE generation <= ?",
+                                           (generation,)).fetchall()
+        return {row[0] for row in rows}
+
+    def discard_tombstones(self, generation: int):
+        """丢弃晚于generation代的墓碑，即没有提交成功的删除"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM tombstones WHERE generation > ?", (generation,))
+            conn.commit()
+
+    def remove(self):
+        """关闭并删除库文件，包括WAL模式的附属文件"""
+        self.close()
+        for path in (self.path, self.path + "-wal", self.path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def compact_to(self, path, removed: List[int]) -> "ChunkStore":
+        """
+        删除给定位置的分段，后面的分段依次前移，与faiss索引删除后的位置保持一致
+        结果写到path处的新库(已有的是上次压缩中途退出留下的，先删除)，本库不变，查询旧快照的线程可以继续读它；
+        新库里没有墓碑
+        """
+        store = ChunkStore(path)
+        store.remove()
+        with self._lock:
+            # 本库保持连接，文件在之后的提交中被删除后仍能通过这个连接读取
+            self._connect()
+        with store._lock:
+            conn = store._connect()
+            conn.execute("ATTACH DATABASE ? AS old", (self.path,))
+            conn.execute("CREATE TEMP TABLE removed (id INTEGER PRIMARY KEY)")
+            conn.executemany("INSERT INTO removed (id) VALUES (?)", ((i,) for i in removed))
+            conn.execute("INSERT INTO sources SELECT id, path FROM old.sources")
+            # 整表按原顺序重新编号，一次写完
+            conn.execute("INSERT INTO chunks SELECT ROW_NUMBER() OVER (ORDER BY id) - 1, "
+                         "text, source_id, page, category, extra FROM old.chunks "
+                         "WHERE id NOT IN (SELECT id FROM removed) ORDER BY id")
+            conn.execute("DROP TABLE removed")
+            conn.commit()
+            conn.execute("DETACH DATABASE old")
+            self._rebuild_fts(conn)
+            conn.commit()
+            store._source_ids = dict((path, i) for i, path in conn.execute("SELECT id, path FROM sources"))
+        return store
+
+    @staticmethod
+    def _rebuild_fts(conn, batch_size=10000):
+        """按chunks表重建倒排索引，用于补建和压缩后的重新编号"""
+        conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+        last = -1
+        while True:
+            rows = conn.execute("SELECT id, text FROM chunks WHERE id > ? ORDER BY id LIMIT ?",
+                                (last, batch_size)).fetchall()
+            if not rows:
+                return
+            conn.executemany("INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)",
+                             ((i, " ".join(tokenize(text))) for i, text in rows))
+            last = rows[-1][0]
+
+    def _doc_freq(self, conn, token):
+        df = self._df_cache.get(token)
+        if df is None:
+            if len(token) == 1 and not token.isascii():
+                # 单个汉字按前缀匹配，取以它开头的各个二元组的文档频率之和(上界)
+                row = conn.execute("SELECT SUM(doc) FROM chunks_fts_vocab WHERE term >= ? AND term < ?",
+                                   (token, token + "\uffff")).fetchone()
+            else:
+                row = conn.execute("SELECT doc FROM chunks_fts_vocab WHERE term = ?", (token,)).fetchone()
+            df = (row[0] if row else None) or 0
+            self._df_cache.put(token, df)
+        return df
+
+    def lexical_search(self, query: str, limit: int, max_df_ratio: float = LEXICAL_MAX_DF_RATIO,
+                       filter: Optional[dict] = None, generation: Optional[int] = None,
+                       end: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        BM25关键词检索，返回 (向量位置, 分数)，分数越大越相关
+        出现在超过max_df_ratio比例分段中的词区分度很低(idf接近0)，却要遍历很长的倒排列表，查询前去掉(大库才会有这种词，
+        出现在不超过LEXICAL_MIN_MAX_DF个分段中的词总是保留)；全是高频词时不做关键词检索，交给向量检索
+        filter为metadata过滤条件(见_filter_sql)；generation不为None时跳过该代及之前删除的分段；end为位置上限(不含)；
+        都在同一条SQL中过滤，不满足条件的分段不占limit
+        """
+        with self._lock:
+            conn = self._connect()
+            max_df = max(LEXICAL_MIN_MAX_DF, int(max_df_ratio * conn.execute(
+                "SELECT COALESCE(MAX(id) + 1, 0) FROM chunks").fetchone()[0]))
+            tokens = [token for token in dict.fromkeys(tokenize(query)) if self._doc_freq(conn, token) <= max_df]
+        match = fts_query(tokens)
+        if not match:
+            return []
+        sql = "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ?"
+        params = [match]
+        if filter:
+            filter_sql, filter_params = self._filter_sql(filter)
+            sql += f" AND rowid IN ({filter_sql})"
+            params.extend(filter_params)
+        if generation is not None:
+            # 对每个命中按主键查墓碑表，耗时与命中数成正比，与墓碑数无关
+            sql += (" AND NOT EXISTS (SELECT 1 FROM tombstones WHERE tombstones.id = chunks_fts.rowid "
+                    "AND tombstones.generation <= ?)")
+            params.append(generation)
+        if end is not None:
+            sql += " AND rowid < ?"
+            params.append(end)
+        with self._lock:
+            rows = self._connect().execute(f"{sql} ORDER BY bm25(chunks_fts) LIMIT ?", params + [limit]).fetchall()
+        # sqlite的bm25()越小越相关
+        return [(i, -score) for i, score in rows]
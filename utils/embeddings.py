@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from configs.model_config import (EMBEDDING_CACHE_PATH, QUERY_EMBEDDING_CACHE_SIZE, EMBEDDING_PROVIDER,
+                                  EMBEDDING_MODEL, LOCAL_EMBEDDING_MODEL)
+from .query_cache import LRUCache
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    在embedding接口前加一层持久化缓存，键为 模型名+分段文本 的sha256，
+    同一个分段无论上传几次、写入几个库，都只请求一次接口
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache_path: str = EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache_path = cache_path
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._conn.commit()
+        self._query_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _get_many(self, keys: List[str]) -> dict:
+        found = {}
+        # sqlite单条语句的参数个数有上限，分批查询
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self._get_many(list(set(keys)))
+        # 同一批里重复的分段也只请求一次
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            rows = []
+            for key, vector in zip(missing.keys(), vectors):
+                cached[key] = vector
+                rows.append((key, np.asarray(vector, dtype=np.float32).tobytes()))
+            with self._lock:
+                self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+                self._conn.commit()
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._query_cache.get(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._query_cache.put(text, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """多个问题合成一次请求，已在LRU中的不再请求"""
+        found = {}
+        for text in texts:
+            vector = self._query_cache.get(text)
+            if vector is not None:
+                found[text] = vector
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        if missing:
+            for text, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                found[text] = vector
+                self._query_cache.put(text, vector)
+        return [found[text] for text in texts]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self._query_cache.get(text)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self._query_cache.put(text, vector)
+        return vector
+
+
+def get_embeddings(provider: str = EMBEDDING_PROVIDER) -> CachedEmbeddings:
+    """
+    按配置创建embedding后端，外面统一套一层持久化缓存
+    openai: 通过共享LLMClient请求接口；local: 本地CPU模型(需安装transformers)
+    """
+    if provider == "openai":
+        from .llm_client import OpenAIClientEmbeddings, get_llm_client
+        return CachedEmbeddings(OpenAIClientEmbeddings(get_llm_client(), EMBEDDING_MODEL), EMBEDDING_MODEL)
+    if provider == "local":
+        from .local_embeddings import LocalEmbeddings
+        return CachedEmbeddings(LocalEmbeddings(LOCAL_EMBEDDING_MODEL), LOCAL_EMBEDDING_MODEL)
+    raise ValueError(f"未知的embedding后端: {provider}")
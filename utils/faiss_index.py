@@ -0,0 +1,118 @@
+import math
+from typing import Iterable, Optional
+
+import faiss
+import numpy as np
+
+from configs.model_config import (VS_INDEX_TYPE, VS_IVF_NLIST, VS_PQ_M, VS_PQ_NBITS, VS_HNSW_M,
+                                  VS_HNSW_EF_CONSTRUCTION, VS_NPROBE, VS_EF_SEARCH)
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# 每个聚类中心最多取多少个训练样本，faiss建议不少于39
+TRAIN_POINTS_PER_CENTROID = 64
+
+
+def is_flat(index: faiss.Index) -> bool:
+    return isinstance(index, faiss.IndexFlat)
+
+
+def ivf_nlist(ntotal: int, nlist: int = VS_IVF_NLIST) -> int:
+    """nlist为0时按 4*sqrt(向量数) 自动取值"""
+    if nlist > 0:
+        return nlist
+    return max(1, int(4 * math.sqrt(ntotal)))
+
+
+def pq_m(dim: int, m: int = VS_PQ_M) -> int:
+    """PQ子向量数必须整除维度，取不超过配置值的最大约数"""
+    m = min(m, dim)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def index_factory_string(index_type: str, dim: int, ntotal: int) -> str:
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{ivf_nlist(ntotal)},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{ivf_nlist(ntotal)},PQ{pq_m(dim)}x{VS_PQ_NBITS}"
+    if index_type == "hnsw":
+        return f"HNSW{VS_HNSW_M},Flat"
+    raise ValueError(f"未知的索引类型: {index_type}，可选 {INDEX_TYPES}")
+
+
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    """按位置顺序取回全部向量，IVF需要先建立id到倒排表的直接映射"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(vectors: np.ndarray, index_type: str = VS_INDEX_TYPE, metric: int = faiss.METRIC_L2) -> faiss.Index:
+    """按配置的类型建索引，需要训练的索引从向量中均匀抽样训练，向量按原顺序写入，位置不变"""
+    ntotal, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_string(index_type, dim, ntotal), metric)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = VS_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        ivf = faiss.extract_index_ivf(index)
+        train_size = min(ntotal, ivf.nlist * TRAIN_POINTS_PER_CENTROID)
+        sample = np.random.default_rng(0).choice(ntotal, train_size, replace=False)
+        index.train(vectors[np.sort(sample)])
+    index.add(vectors)
+    return index
+
+
+def convert_index(index: faiss.Index, index_type: str = VS_INDEX_TYPE) -> faiss.Index:
+    """把已有索引(一般是暴力检索的Flat)转成配置的类型，保持度量方式和向量位置"""
+    return build_index(reconstruct_all(index), index_type, index.metric_type)
+
+
+def remove_positions(index: faiss.Index, removed: Iterable[int]) -> faiss.Index:
+    """
+    删除给定位置的向量，其后的向量依次前移
+    Flat直接remove_ids；IVF的remove_ids不会重排位置、HNSW不支持删除，
+    这两类clone后reset，保留训练好的聚类中心/码本，重新写入剩余向量
+    """
+    removed = np.array(sorted(removed), dtype=np.int64)
+    if is_flat(index):
+        index.remove_ids(removed)
+        return index
+    keep = np.ones(index.ntotal, dtype=bool)
+    keep[removed] = False
+    vectors = reconstruct_all(index)[keep]
+    new_index = faiss.clone_index(index)
+    new_index.reset()
+    new_index.add(vectors)
+    return new_index
+
+
+def id_selector(mask: np.ndarray) -> faiss.IDSelectorBitmap:
+    """
+    按布尔掩码(下标即向量位置)构造IDSelector，在faiss检索内部跳过未选中的向量
+    位图每个向量只占1位，百万向量约125KB
+    """
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+    # IDSelectorBitmap只保存指针，位图须与selector同生命周期
+    selector.referenced_objects = [bitmap]
+    return selector
+
+
+def search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  selector: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+    """
+    单次查询的检索参数，不修改共享索引上的nprobe/efSearch，多个请求并发查询时互不影响
+    selector只检索选中的向量(过滤条件、墓碑)；Flat索引且没有selector时返回None
+    """
+    if faiss.try_extract_index_ivf(index) is not None:
+        nlist = faiss.extract_index_ivf(index).nlist
+        return faiss.SearchParametersIVF(nprobe=min(nprobe or VS_NPROBE, nlist), sel=selector)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or VS_EF_SEARCH, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
@@ -0,0 +1,122 @@
+import contextlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from configs.model_config import *
+from loader.registry import COST_HEAVY, COST_LIGHT, get_loader
+from .utils import load_file, VectorStore
+
+
+def _init_parse_worker(page_workers):
+    # 多个文件已经在并行解析，单个PDF内部的按页并行相应减少，避免进程数超过核数太多
+    # 只在解析子进程中导入PDF loader(fitz、paddleocr)，主进程不加载
+    from loader import pdf_loader
+
+    pdf_loader.set_page_workers(page_workers)
+
+
+def _parse_file(filepath, sentence_size):
+    """在解析池中读取并切分单个文件"""
+    return load_file(filepath, sentence_size=sentence_size)
+
+
+def _parse_pool(cost, files):
+    """OCR类文件用进程池，纯文本类和联网拉取的文件各用一个线程池"""
+    if cost == COST_HEAVY:
+        workers = min(INGEST_PROCESSES, files)
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_START_METHOD),
+                                   initializer=_init_parse_worker, initargs=(PDF_PAGE_WORKERS // workers,))
+    return ThreadPoolExecutor(max_workers=min(INGEST_THREADS if cost == COST_LIGHT else INGEST_NETWORK_THREADS, files))
+
+
+def embed_texts(embeddings, texts, batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY):
+    """把分段按batch_size合批，最多concurrency个请求同时进行，按原顺序返回向量"""
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return [vector for vectors in pool.map(embeddings.embed_documents, batches) for vector in vectors]
+
+
+def ingest_files(file_paths, sentence_size=SENTENCE_SIZE, kb_name="知识库", progress=None, cancelled=None):
+    """
+    批量入库流水线：按格式的解析开销分池并行解析切分 -> 跨文件合批并发embedding -> 每批只提交一次合并库
+    PDF、图片的OCR在进程池中进行，纯文本类文件在线程池中解析，不会排在OCR后面等待
+    :param file_paths: 已保存到docs目录的文件路径列表
+    :param progress: 回调 progress(filename, stage, info)，stage依次为 parsed/embedded/indexed，出错时为 failed，
+                     被取消时为 cancelled
+    :param cancelled: 返回True时停止入库，已经提交合并库的文件保留，其余文件不再处理
+    :return: 文件名 -> 处理结果
+    """
+    vector_store = VectorStore()
+    results = {}
+    pending = []
+    report = progress or (lambda filename, stage, info="": None)
+    stop = cancelled or (lambda: False)
+
+    def fail(filename, info):
+        logger.warning(info)
+        results[filename] = info
+        report(filename, "failed", info)
+
+    def flush():
+        texts = [doc.page_content for _, docs in pending for doc in docs]
+        try:
+            vectors = embed_texts(vector_store.embeddings, texts)
+        except Exception as e:
+            for filename, _ in pending:
+                fail(filename, f"failed to embed file {filename},{e}")
+            pending.clear()
+            return
+        batch = []
+        offset = 0
+        for filename, docs in pending:
+            batch.append((filename.split('.')[0], docs, vectors[offset:offset + len(docs)]))
+            offset += len(docs)
+            report(filename, "embedded", len(docs))
+        try:
+            vector_store.add_embedded_documents(batch, kb_name=kb_name)
+        except Exception as e:
+            for filename, _ in pending:
+                fail(filename, f"failed to add file {filename} vector_store,error:{e}")
+        else:
+            for filename, docs in pending:
+                results[filename] = f"已增加文件{filename}至数据库"
+                report(filename, "indexed", len(docs))
+        pending.clear()
+
+    groups = {}
+    for filepath in file_paths:
+        groups.setdefault(get_loader(filepath).cost, []).append(filepath)
+    with contextlib.ExitStack() as stack:
+        futures = {}
+        for cost, paths in groups.items():
+            pool = stack.enter_context(_parse_pool(cost, len(paths)))
+            futures.update({pool.submit(_parse_file, filepath, sentence_size): filepath for filepath in paths})
+        # 先解析完的文件先进入embedding，其余文件继续在子进程中解析
+        for future in as_completed(futures):
+            if stop():
+                # 还没开始解析的文件直接取消，正在解析的等解析完后丢弃
+                for other in futures:
+                    other.cancel()
+                break
+            filename = os.path.basename(futures[future])
+            try:
+                docs = future.result()
+            except Exception as e:
+                fail(filename, f"failed to load file {filename},{e}")
+                continue
+            if not docs:
+                fail(filename, f"文件{filename}中没有可入库的内容")
+                continue
+            report(filename, "parsed", len(docs))
+            pending.append((filename, docs))
+            if sum(len(docs) for _, docs in pending) >= INGEST_COMMIT_CHUNKS:
+                flush()
+    if pending and not stop():
+        flush()
+    for filepath in file_paths:
+        filename = os.path.basename(filepath)
+        if filename not in results:
+            results[filename] = f"已取消文件{filename}的入库"
+            report(filename, "cancelled")
+    return results
@@ -0,0 +1,275 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from configs.model_config import DOCS_PATH, JOB_POLL_SECONDS, JOBS_DB_PATH, SENTENCE_SIZE, logger
+from .ingest import ingest_files
+from .sync import sync_docs
+from .utils import VectorStore, singleton
+
+# 任务种类：入库一批文件、删除一批文件、按docs目录同步、清空整个知识库
+JOB_KINDS = ("ingest", "delete", "sync", "clear")
+# 文件处理到这些阶段即结束
+FINISHED_STAGES = ("indexed", "deleted", "failed", "cancelled")
+
+
+def _lock_file(f):
+    """阻塞直到取得文件的排他锁；持有锁的进程退出(包括崩溃)时由操作系统释放"""
+    if os.name == "nt":
+        import msvcrt
+
+        while True:
+            try:
+                # LK_LOCK重试10秒后仍拿不到锁时抛出OSError
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+    import fcntl
+
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+@singleton
+class JobQueue:
+    """
+    SQLite持久化的后台任务队列：上传、删除、同步提交后立即返回任务号，由工作线程依次执行
+    每个文件的阶段(queued/parsed/embedded/indexed，或 deleted/failed/cancelled)写入任务库，页面轮询查看
+    同一个任务库可以被多个进程(gradio、多个API worker、python -m utils.jobs)共用，都可以提交、查询、取消任务；
+    各进程的工作线程争用任务库旁的锁文件，只有持有锁的一个进程执行任务，合并库的写入不会交错；
+    它退出后由另一个进程接替，把它执行到一半的任务重新排队，已经入库的文件不再重复处理
+    """
+
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._worker_lock = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT, kb_name TEXT, "
+                           "params TEXT, status TEXT, error TEXT, cancel INTEGER DEFAULT 0, "
+                           "created REAL, started REAL, finished REAL, pid INTEGER)")
+        if "pid" not in [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS job_files (job_id INTEGER, filename TEXT, path TEXT, "
+                           "stage TEXT, info TEXT, PRIMARY KEY (job_id, filename))")
+        self._conn.commit()
+
+    def start(self):
+        """启动本进程的工作线程，拿到锁文件后才开始执行任务；重复调用无影响"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job-worker", daemon=True)
+                self._thread.start()
+
+    def _submit(self, kind, kb_name, params, files):
+        with self._lock:
+            job_id = self._conn.execute(
+                "INSERT INTO jobs (kind, kb_name, params, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                (kind, kb_name, json.dumps(params, ensure_ascii=False), time.time())).lastrowid
+            self._conn.executemany("INSERT INTO job_files (job_id, filename, path, stage) VALUES (?, ?, ?, 'queued')",
+                                   ((job_id, os.path.basename(path), path) for path in files))
+            self._conn.commit()
+            self._wakeup.notify()
+        self.start()
+        return job_id
+
+    def submit_ingest(self, file_paths: List[str], sentence_size=SENTENCE_SIZE, kb_name="知识库") -> int:
+        """入库docs目录中已保存的文件，返回任务号"""
+        return self._submit("ingest", kb_name, {"sentence_size": sentence_size}, file_paths)
+
+    def submit_delete(self, filenames: List[str], kb_name="知识库") -> int:
+        """从合并库删除文件(文件名basename)，返回任务号"""
+        return self._submit("delete", kb_name, {}, filenames)
+
+    def submit_sync(self, docs_dir=DOCS_PATH, sentence_size=SENTENCE_SIZE, kb_name="知识库") -> int:
+        """按docs目录增量同步，涉及的文件在扫描后才登记，返回任务号"""
+        return self._submit("sync", kb_name, {"docs_dir": docs_dir, "sentence_size": sentence_size}, [])
+
+    def submit_clear(self, kb_name="知识库") -> int:
+        """删除整个知识库，排在之前提交的任务之后执行，返回任务号"""
+        return self._submit("clear", kb_name, {}, [])
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        排队中的任务直接取消；执行中的入库、同步任务在处理下一个文件前停止，已经入库的文件保留
+        :return: 任务是否还未结束
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] not in ("queued", "running"):
+                return False
+            if row[0] == "queued":
+                self._conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?",
+                                   (time.time(), job_id))
+                self._conn.execute("UPDATE job_files SET stage = 'cancelled' WHERE job_id = ? AND stage = 'queued'",
+                                   (job_id,))
+            else:
+                self._conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ?", (job_id,))
+            self._conn.commit()
+            return True
+
+    def retry(self, job_id: int) -> Optional[int]:
+        """把任务中失败和被取消的文件作为新任务重新提交，没有这样的文件时返回None"""
+        with self._lock:
+            job = self._conn.execute("SELECT kind, kb_name, params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            paths = [row[0] for row in self._conn.execute(
+                "SELECT path FROM job_files WHERE job_id = ? AND stage IN ('failed', 'cancelled')", (job_id,))]
+        if job is None or not paths:
+            return None
+        kind, kb_name, params = job
+        params = json.loads(params)
+        if kind == "delete":
+            return self.submit_delete(paths, kb_name)
+        # 同步任务中失败的文件按普通入库重试
+        return self.submit_ingest(paths, params.get("sentence_size", SENTENCE_SIZE), kb_name)
+
+    def status(self, job_id: int) -> Optional[dict]:
+        """
+        :return: {"id", "kind", "status", "error", "created", "started", "finished",
+                  "files": [{"filename", "stage", "info"}, ...], "done": 已结束的文件数, "total": 文件数}
+        """
+        with self._lock:
+            job = self._conn.execute("SELECT id, kind, status, error, created, started, finished FROM jobs "
+                                     "WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            files = self._conn.execute("SELECT filename, stage, info FROM job_files WHERE job_id = ? ORDER BY rowid",
+                                       (job_id,)).fetchall()
+        result = dict(zip(("id", "kind", "status", "error", "created", "started", "finished"), job))
+        result["files"] = [{"filename": filename, "stage": stage, "info": info} for filename, stage, info in files]
+        result["done"] = sum(stage in FINISHED_STAGES for _, stage, _ in files)
+        result["total"] = len(files)
+        return result
+
+    def list_jobs(self, limit=10) -> List[dict]:
+        """最近提交的任务，新的在前"""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute("SELECT id FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
+        return [self.status(job_id) for job_id in ids]
+
+    def _requeue_orphans(self):
+        """
+        刚拿到锁文件时调用：之前持有锁的进程已经退出(崩溃、重启)，它留下的执行中任务重新排队
+        执行任务的只有持锁进程，不必按pid判断进程是否还活着(容器重启后pid会被复用)
+        """
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'queued', pid = NULL WHERE status = 'running'")
+            self._conn.commit()
+
+    def _claim(self):
+        """
+        取出最早排队的任务并标记为执行中，没有任务时等待；只在持有锁文件的进程中调用
+        """
+        with self._lock:
+            while True:
+                row = self._conn.execute("SELECT id, kind, kb_name, params FROM jobs WHERE status = 'queued' "
+                                         "ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    claimed = self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started = ?, pid = ? WHERE id = ? AND status = 'queued' "
+                        "AND NOT EXISTS (SELECT 1 FROM jobs WHERE status = 'running')",
+                        (time.time(), os.getpid(), row[0])).rowcount
+                    self._conn.commit()
+                    if claimed:
+                        return row
+                # 其他进程提交的任务不会唤醒本进程，定时再查
+                self._wakeup.wait(JOB_POLL_SECONDS)
+
+    def _set_stage(self, job_id, filename, stage, info="", docs_dir=DOCS_PATH):
+        with self._lock:
+            # 同步任务的文件在扫描后才第一次登记
+            self._conn.execute("INSERT INTO job_files (job_id, filename, path, stage, info) VALUES (?, ?, ?, ?, ?) "
+                               "ON CONFLICT (job_id, filename) DO UPDATE SET stage = excluded.stage, "
+                               "info = excluded.info",
+                               (job_id, filename, os.path.join(docs_dir, filename), stage, str(info)))
+            self._conn.commit()
+
+    def _cancelled(self, job_id):
+        with self._lock:
+            return bool(self._conn.execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+    def _run(self):
+        self._worker_lock = open(self.path + ".worker.lock", "a+")
+        _lock_file(self._worker_lock)
+        logger.info(f"进程{os.getpid()}开始执行任务库{self.path}中的任务")
+        self._requeue_orphans()
+        try:
+            # 迁移旧版本存储、丢弃上一个写入进程崩溃留下的多余分段
+            VectorStore().repair()
+        except Exception:
+            logger.exception("修复合并库失败")
+        while True:
+            job_id, kind, kb_name, params = self._claim()
+            try:
+                self._execute(job_id, kind, kb_name, json.loads(params))
+                error = None
+            except Exception as e:
+                logger.exception(f"任务{job_id}执行失败")
+                error = str(e)
+            with self._lock:
+                stages = {stage for stage, in self._conn.execute("SELECT stage FROM job_files WHERE job_id = ?",
+                                                                 (job_id,))}
+                status = "failed" if error or "failed" in stages else "cancelled" if "cancelled" in stages else "done"
+                self._conn.execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                                   (status, error, time.time(), job_id))
+                self._conn.commit()
+
+    def _execute(self, job_id, kind, kb_name, params):
+        with self._lock:
+            files = self._conn.execute("SELECT filename, path FROM job_files WHERE job_id = ? AND stage NOT IN "
+                                       f"({','.join('?' * len(FINISHED_STAGES))})",
+                                       (job_id, *FINISHED_STAGES)).fetchall()
+
+        def report(filename, stage, info=""):
+            self._set_stage(job_id, filename, stage, info, params.get("docs_dir", DOCS_PATH))
+
+        def cancelled():
+            return self._cancelled(job_id)
+
+        # 只有本进程写合并库，此时没有其他写入方，可以修复；同时加载其他进程之前写入的合并库
+        VectorStore().repair(kb_name)
+        if kind == "ingest":
+            # 重新排队的任务只处理还没结束的文件
+            ingest_files([path for _, path in files], sentence_size=params["sentence_size"], kb_name=kb_name,
+                         progress=report, cancelled=cancelled)
+        elif kind == "delete":
+            vector_store = VectorStore()
+            vector_store.load_knowledge_base(kb_name)
+            filenames = [filename for filename, _ in files]
+            # 不在知识库中的文件记为失败，页面上不显示成删除成功
+            missing = [filename for filename in filenames
+                       if vector_store.catalog is None or filename not in vector_store.catalog]
+            for filename in missing:
+                report(filename, "failed", f"文件{filename}不存在")
+            filenames = [filename for filename in filenames if filename not in missing]
+            if filenames:
+                info = vector_store.delete_vector_stores(filenames)
+                for filename in filenames:
+                    report(filename, "deleted", info)
+        elif kind == "sync":
+            summary = sync_docs(params["docs_dir"], params["sentence_size"], kb_name, progress=report,
+                                cancelled=cancelled)
+            for filename in summary["removed"]:
+                report(filename, "deleted")
+        elif kind == "clear":
+            vector_store = VectorStore()
+            info = vector_store.delete_vector_store()
+            if os.path.exists(vector_store.vs_path):
+                raise RuntimeError(info)
+        else:
+            raise ValueError(f"未知的任务种类{kind}，可选{JOB_KINDS}")
+
+
+if __name__ == "__main__":
+    # 单独的任务进程：API以多worker运行时，由它执行提交的入库、删除、同步任务
+    logger.info(f"任务进程已启动，任务库{JOBS_DB_PATH}")
+    queue = JobQueue()
+    queue.start()
+    queue._thread.join()
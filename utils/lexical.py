@@ -0,0 +1,53 @@
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Tuple
+
+# 连续的汉字，或由字母数字组成、可以带 - _ . 连接的编号(型号、订单号等)
+TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+CODE_PART_RE = re.compile(r"[-_.]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    面向倒排索引的中文分词，不依赖词典：
+    汉字按相邻两字切成二元组，单独的一个汉字保留为一元；字母数字编号整体作为一个词，带连接符的同时拆出各段
+    """
+    tokens = []
+    for match in TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        word = match.group()
+        if word[0].isascii():
+            tokens.append(word)
+            if CODE_PART_RE.search(word):
+                tokens.extend(part for part in CODE_PART_RE.split(word) if part)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def fts_query(tokens: Iterable[str]) -> str:
+    """
+    拼成FTS5的OR查询，每个词加引号避免 - 等字符被当成运算符
+    单个汉字在索引里只出现在二元组中，改为前缀匹配
+    """
+    terms = []
+    for token in dict.fromkeys(tokens):
+        term = '"' + token.replace('"', '""') + '"'
+        if len(token) == 1 and not token.isascii():
+            term += " *"
+        terms.append(term)
+    return " OR ".join(terms)
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], weights: List[float], k: int = 60) -> List[Tuple[int, float]]:
+    """
+    加权倒数排名融合：score = Σ weight / (k + rank)，rank从1开始
+    分数除以所有结果都排第一时的最大值，归一化到[0, 1]，按分数从高到低返回 (id, score)
+    """
+    scores: Dict[int, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, i in enumerate(ranking, start=1):
+            scores[i] = scores.get(i, 0.0) + weight / (k + rank)
+    best = sum(weights) / (k + 1) or 1.0
+    return sorted(((i, score / best) for i, score in scores.items()), key=lambda item: item[1], reverse=True)
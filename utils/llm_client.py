@@ -0,0 +1,171 @@
+import asyncio
+import random
+import threading
+import time
+from typing import AsyncIterator, List
+
+import aiohttp
+import openai
+import requests
+from langchain.embeddings.base import Embeddings
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from requests.adapters import HTTPAdapter
+
+from configs.model_config import *
+
+# 可以重试的错误：限流、超时、连接失败、服务端暂时不可用
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def to_openai_messages(messages: List[BaseMessage]) -> List[dict]:
+    roles = {SystemMessage: "system", HumanMessage: "user", AIMessage: "assistant"}
+    return [{"role": roles.get(type(message), "user"), "content": message.content} for message in messages]
+
+
+class LLMClient:
+    """
+    聊天和embedding共用的OpenAI客户端
+    同步调用共享一个requests连接池，异步调用共享一个aiohttp连接池，
+    同时进行的请求数不超过max_concurrency，限流等可恢复的错误按指数退避重试
+    """
+
+    def __init__(self, api_base: str = OPENAI_API_BASE, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_retries: int = LLM_MAX_RETRIES):
+        self.api_base = api_base
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        openai.proxy = OPENAI_PROXY
+        self._sync_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self._sync_session.mount("http://", adapter)
+        self._sync_session.mount("https://", adapter)
+        openai.requestssession = self._sync_session
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+        # 事件循环 -> (aiohttp会话, 信号量, 关闭会话的异步生成器)
+        self._loop_states = {}
+
+    async def _async_state(self):
+        # aiohttp会话和信号量都绑定在事件循环上，每个循环各建一套
+        loop = asyncio.get_running_loop()
+        state = self._loop_states.get(loop)
+        if state is None:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            closer = self._close_with_loop(loop, session)
+            # 先迭代一次，让事件循环记录这个异步生成器，循环关闭前(如asyncio.run结束时)会调用它的aclose
+            await closer.__anext__()
+            state = self._loop_states[loop] = (session, asyncio.Semaphore(self.max_concurrency), closer)
+        return state[0], state[1]
+
+    async def _close_with_loop(self, loop, session):
+        try:
+            yield
+        finally:
+            self._loop_states.pop(loop, None)
+            await session.close()
+
+    def _retry_wait(self, error: Exception, attempt: int) -> float:
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(LLM_RETRY_MAX_WAIT, LLM_RETRY_BASE_WAIT * 2 ** attempt) * (1 + random.random() / 2)
+
+    def _call(self, resource, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._sync_semaphore:
+                    return resource.create(api_base=self.api_base, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = self._retry_wait(e, attempt)
+                logger.warning(f"OpenAI请求失败，{wait:.1f}秒后重试: {e}")
+                time.sleep(wait)
+
+    async def _acreate(self, resource, **kwargs):
+        session, _ = await self._async_state()
+        for attempt in range(self.max_retries + 1):
+            token = openai.aiosession.set(session)
+            try:
+                return await resource.acreate(api_base=self.api_base, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = self._retry_wait(e, attempt)
+                logger.warning(f"OpenAI请求失败，{wait:.1f}秒后重试: {e}")
+                await asyncio.sleep(wait)
+            finally:
+                openai.aiosession.reset(token)
+
+    async def _acall(self, resource, **kwargs):
+        _, semaphore = await self._async_state()
+        async with semaphore:
+            return await self._acreate(resource, **kwargs)
+
+    def embed(self, texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        response = self._call(openai.Embedding, input=texts, model=model)
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    async def aembed(self, texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        response = await self._acall(openai.Embedding, input=texts, model=model)
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    async def astream_chat(self, messages: List[BaseMessage], temperature: float = 0.7,
+                           model_name: str = CHAT_MODEL) -> AsyncIterator[str]:
+        """流式返回回答；只在收到第一个token之前重试，整个流式过程占用一个并发名额"""
+        _, semaphore = await self._async_state()
+        async with semaphore:
+            response = await self._acreate(openai.ChatCompletion, model=model_name, temperature=temperature,
+                                           messages=to_openai_messages(messages), stream=True)
+            async for chunk in response:
+                token = chunk["choices"][0]["delta"].get("content")
+                if token:
+                    yield token
+
+
+class OpenAIClientEmbeddings(Embeddings):
+    """基于共享LLMClient的OpenAI embedding，提供同步与异步接口"""
+
+    def __init__(self, client: LLMClient, model: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector for batch in self._batches(texts) for vector in self.client.embed(batch, model=self.model)]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.embed([text], model=self.model)[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # 各批并发请求，同时进行的请求数受LLMClient的信号量限制
+        results = await asyncio.gather(*[self.client.aembed(batch, model=self.model) for batch in self._batches(texts)])
+        return [vector for vectors in results for vector in vectors]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.client.aembed([text], model=self.model))[0]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """进程内共享的客户端"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+        return _client
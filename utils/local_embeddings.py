@@ -0,0 +1,110 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+import torch
+from langchain.embeddings.base import Embeddings
+
+from configs.model_config import (LOCAL_EMBEDDING_MODEL, LOCAL_EMBEDDING_THREADS, LOCAL_EMBEDDING_BATCH_SIZE,
+                                  LOCAL_EMBEDDING_MAX_WAIT_MS, LOCAL_EMBEDDING_MAX_LENGTH, LOCAL_EMBEDDING_QUANTIZE,
+                                  logger)
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    本地CPU上运行的text2vec/sentence-transformer类模型，不依赖外部接口
+    所有请求进入同一个队列，由唯一的推理线程合并成批次(动态批处理)：
+    并发到达的多个问题会在LOCAL_EMBEDDING_MAX_WAIT_MS内凑成一批，入库的大批分段按批次大小切开
+    """
+
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL, num_threads: int = LOCAL_EMBEDDING_THREADS,
+                 batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE, max_wait_ms: float = LOCAL_EMBEDDING_MAX_WAIT_MS,
+                 max_length: int = LOCAL_EMBEDDING_MAX_LENGTH, quantize: bool = LOCAL_EMBEDDING_QUANTIZE):
+        from transformers import AutoModel, AutoTokenizer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_length = max_length
+        torch.set_num_threads(num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name).eval()
+        if quantize:
+            # 动态int8量化只作用于Linear层，CPU上推理提速明显，向量精度略有下降
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._serve, name="local-embeddings", daemon=True)
+        self._worker.start()
+        logger.info(f"本地embedding模型已加载: {model_name}, 线程数{num_threads}, int8量化{quantize}")
+
+    @torch.inference_mode()
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length,
+                                return_tensors="pt")
+        output = self.model(**inputs).last_hidden_state
+        # mean pooling，忽略padding位置，再做L2归一化
+        mask = inputs["attention_mask"].unsqueeze(-1).to(output.dtype)
+        vectors = (output * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(vectors, p=2, dim=1).tolist()
+
+    def _next_batch(self):
+        """阻塞取出第一个请求，再在等待窗口内尽量多取，直到凑满一批"""
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            # 按长度排序后再分批，减少padding
+            order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+            vectors = [None] * len(texts)
+            try:
+                for start in range(0, len(order), self.batch_size):
+                    ids = order[start:start + self.batch_size]
+                    for i, vector in zip(ids, self._encode([texts[i] for i in ids])):
+                        vectors[i] = vector
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for item_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    def _submit(self, texts: List[str]) -> Future:
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        futures = [self._submit(texts[i:i + self.batch_size]) for i in range(0, len(texts), self.batch_size)]
+        return [vector for future in futures for vector in future.result()]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit([text]).result()[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await asyncio.wrap_future(self._submit([text])))[0]
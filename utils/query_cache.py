@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+import numpy as np
+
+
+class LRUCache:
+    """线程安全的LRU缓存，ttl为None时不过期"""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, created = item
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存：问题向量与已缓存问题的余弦相似度不低于threshold，
+    且知识库版本和检索参数一致时直接返回缓存的结果
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float], threshold: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = []
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self):
+        if self.ttl is None:
+            return
+        now = time.time()
+        entries = [entry for entry in self._entries if now - entry["time"] <= self.ttl]
+        if len(entries) != len(self._entries):
+            self._entries = entries
+            self._matrix = None
+
+    def get(self, vector: List[float], version: int, params: Hashable = None) -> Any:
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([entry["vector"] for entry in self._entries])
+            similarities = self._matrix @ self._normalize(vector)
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                entry = self._entries[i]
+                if entry["version"] == version and entry["params"] == params:
+                    return entry["value"]
+            return None
+
+    def put(self, vector: List[float], version: int, params: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries.append({
+                "vector": self._normalize(vector),
+                "version": version,
+                "params": params,
+                "value": value,
+                "time": time.time(),
+            })
+            # 超出容量时淘汰最早写入的条目
+            del self._entries[:-self.maxsize]
+            self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = []
+            self._matrix = None
+
+    def __len__(self):
+        return len(self._entries)
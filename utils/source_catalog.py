@@ -0,0 +1,119 @@
+import bisect
+import hashlib
+import json
+import os
+import time
+
+
+def file_stat(filepath):
+    """文件大小与修改时间，文件不存在时返回(None, None)"""
+    if not filepath or not os.path.isfile(filepath):
+        return None, None
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime
+
+
+def file_hash(filepath, chunk_size=1 << 20):
+    """文件内容的sha256，文件不存在时返回None"""
+    if not filepath or not os.path.isfile(filepath):
+        return None
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class SourceCatalog:
+    """
+    知识库的文件目录，随合并库增删增量维护，列出文件只需O(文件数)
+    每个文件记录: 路径、分段数、在合并库中的向量位置区间、入库时间、内容哈希、入库时的文件大小和修改时间
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+
+    @classmethod
+    def load(cls, path):
+        catalog = cls(path)
+        with open(path, encoding="utf-8") as f:
+            catalog.sources = json.load(f)
+        return catalog
+
+    @classmethod
+    def from_documents(cls, path, documents):
+        """旧版本的知识库没有目录，按向量位置顺序扫描一遍全部分段生成"""
+        catalog = cls(path)
+        for i, doc in enumerate(documents):
+            source = doc.metadata.get("source")
+            entry = catalog.sources.setdefault(os.path.basename(source), {
+                "path": source,
+                "chunks": 0,
+                "ranges": [],
+                "ingest_time": None,
+                "content_hash": None,
+                "size": None,
+                "mtime": None,
+            })
+            entry["chunks"] += 1
+            ranges = entry["ranges"]
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+        return catalog
+
+    def save(self, path=None):
+        """先写临时文件再替换，读到的总是完整的目录；path默认为self.path"""
+        path = path or self.path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.sources, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def __contains__(self, filename):
+        return filename in self.sources
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, documents, start):
+        """documents按顺序写在合并库的start位置之后，按文件名登记"""
+        added = {}
+        for i, doc in enumerate(documents, start=start):
+            source = doc.metadata.get("source")
+            filename = os.path.basename(source)
+            if filename not in added:
+                size, mtime = file_stat(source)
+                added[filename] = {
+                    "path": source,
+                    "chunks": 0,
+                    "ranges": [],
+                    "ingest_time": time.time(),
+                    "content_hash": file_hash(source),
+                    "size": size,
+                    "mtime": mtime,
+                }
+            entry = added[filename]
+            entry["chunks"] += 1
+            ranges = entry["ranges"]
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+        self.sources.update(added)
+        return added
+
+    def remove(self, filename):
+        """删除一个文件的登记，返回它占用的向量位置区间"""
+        return self.sources.pop(filename)["ranges"]
+
+    def remap(self, removed):
+        """合并库压缩掉removed(已排序)这些位置后，把其余文件的区间前移"""
+        for entry in self.sources.values():
+            entry["ranges"] = [[start - bisect.bisect_left(removed, start),
+                                end - bisect.bisect_left(removed, end)] for start, end in entry["ranges"]]
+
+    def docs_dict(self):
+        return {filename: entry["path"] for filename, entry in self.sources.items()}
@@ -0,0 +1,91 @@
+import argparse
+import os
+
+from configs.model_config import DOCS_PATH, SENTENCE_SIZE, logger
+from .ingest import ingest_files
+from .source_catalog import file_hash, file_stat
+from .utils import VectorStore
+
+
+def scan_changes(catalog, docs_dir):
+    """
+    对比docs目录与文件目录(入库时记录的大小、修改时间、内容哈希)
+    大小和修改时间都没变的直接跳过，变了再算哈希确认内容是否真的改动
+    :return: (新增文件路径, 改动文件路径, 已删除的文件名, 未改动文件数, 仅修改时间变化的文件名)
+    """
+    added, changed, touched = [], [], []
+    unchanged = 0
+    seen = set()
+    for filename in sorted(os.listdir(docs_dir)):
+        filepath = os.path.join(docs_dir, filename)
+        if not os.path.isfile(filepath):
+            continue
+        seen.add(filename)
+        entry = catalog.sources.get(filename)
+        if entry is None:
+            added.append(filepath)
+            continue
+        size, mtime = file_stat(filepath)
+        if entry.get("size") == size and entry.get("mtime") == mtime:
+            unchanged += 1
+        elif entry.get("content_hash") is not None and entry["content_hash"] == file_hash(filepath):
+            touched.append(filename)
+            unchanged += 1
+        else:
+            changed.append(filepath)
+    docs_dir = os.path.abspath(docs_dir)
+    # 只删除原本来自docs目录、现在已经不存在的文件，其他目录入库的文件不受影响
+    removed = [filename for filename, entry in catalog.sources.items()
+               if filename not in seen and os.path.dirname(os.path.abspath(entry["path"])) == docs_dir]
+    return added, changed, removed, unchanged, touched
+
+
+def sync_docs(docs_dir=DOCS_PATH, sentence_size=SENTENCE_SIZE, kb_name="知识库", progress=None, cancelled=None):
+    """
+    按docs目录增量更新知识库：只重新入库新增和改动的文件，删除已不存在文件的向量，未改动的文件跳过
+    改动文件的旧向量在重新入库时自动打上墓碑，分段的向量也会命中embedding缓存
+    :param progress: 同ingest_files
+    :param cancelled: 同ingest_files
+    :return: {"added": [...], "changed": [...], "removed": [...], "unchanged": 数量, "failed": {文件名: 原因}}
+    """
+    vector_store = VectorStore()
+    os.makedirs(docs_dir, exist_ok=True)
+    # 扫描期间不允许其他上传、删除改动文件目录
+    with vector_store.write_lock:
+        vector_store.load_knowledge_base(kb_name)
+        added, changed, removed, unchanged, touched = scan_changes(vector_store.catalog, docs_dir)
+        logger.info(f"同步{docs_dir}: 新增{len(added)}，改动{len(changed)}，删除{len(removed)}，未改动{unchanged}")
+        if removed:
+            vector_store.delete_vector_stores(removed)
+        if touched:
+            # 内容没变只是修改时间变了，更新记录，下次不必再算哈希
+            vector_store.update_file_stats(touched)
+    failed = {}
+
+    def report(filename, stage, info=""):
+        if stage == "failed":
+            failed[filename] = info
+        if progress is not None:
+            progress(filename, stage, info)
+
+    if added or changed:
+        ingest_files(added + changed, sentence_size=sentence_size, kb_name=kb_name, progress=report,
+                     cancelled=cancelled)
+    return {
+        "added": [os.path.basename(path) for path in added],
+        "changed": [os.path.basename(path) for path in changed],
+        "removed": removed,
+        "unchanged": unchanged,
+        "failed": failed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按docs目录增量同步知识库")
+    parser.add_argument("--docs-dir", default=DOCS_PATH)
+    parser.add_argument("--kb-name", default="知识库")
+    parser.add_argument("--sentence-size", type=int, default=SENTENCE_SIZE)
+    args = parser.parse_args()
+    summary = sync_docs(args.docs_dir, args.sentence_size, args.kb_name)
+    for key, value in summary.items():
+        print(f"{key}: {value}")
@@ -1,13 +1,24 @@
+import functools
+import json
+import re
 import shutil
-from typing import List
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
 
+import faiss
+import numpy as np
 import pypinyin
-import torch
 from .MyFAISS import MyFAISS
+from .embeddings import get_embeddings
+from .source_catalog import SourceCatalog, file_stat
+from .chunk_store import ChunkStore
+from .faiss_index import is_flat, convert_index, remove_positions, search_params, id_selector
+from .query_cache import LRUCache, SemanticAnswerCache
+from .lexical import reciprocal_rank_fusion
 
 from configs.model_config import *
-from langchain.document_loaders import UnstructuredFileLoader, TextLoader, CSVLoader
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.docstore import InMemoryDocstore
 from pydantic import BaseModel
 from langchain.schema import (
     AIMessage,
@@ -17,23 +28,30 @@ from langchain.schema import (
     SystemMessage
 )
 from configs.model_config import logger
-from loader import UnstructuredPaddlePDFLoader, UnstructuredPaddleImageLoader
-from textsplitter import ChineseTextSplitter
+# 各格式的loader按文件头、扩展名注册在loader.registry中
+from loader.registry import load_file
 
 
 def singleton(cls):
     instance = None
+    lock = threading.Lock()
 
     def wrapper(*args, **kwargs):
         nonlocal instance
         if instance is None:
-            instance = cls(*args, **kwargs)
+            # 多个请求线程同时第一次调用时只创建一个实例
+            with lock:
+                if instance is None:
+                    instance = cls(*args, **kwargs)
         return instance
 
     return wrapper
 
 
 def torch_gc():
+    # torch只有本地模型会用到，导入要数秒，不在模块加载时导入
+    import torch
+
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
@@ -67,86 +85,456 @@ class ChatMessageHistory(BaseChatMessageHistory, BaseModel):
         self.messages = []
 
 
-def load_file(filepath, sentence_size=100):
-    if filepath.lower().endswith(".md"):
-        loader = UnstructuredFileLoader(filepath, mode="elements")
-        docs = loader.load()
-    elif filepath.lower().endswith(".txt"):
-        loader = TextLoader(filepath)
-        textsplitter = ChineseTextSplitter(pdf=False, sentence_size=sentence_size)
-        docs = loader.load_and_split(textsplitter)
-    elif filepath.lower().endswith(".pdf"):
-        loader = UnstructuredPaddlePDFLoader(filepath)
-        textsplitter = ChineseTextSplitter(pdf=True, sentence_size=sentence_size)
-        docs = loader.load_and_split(textsplitter)
-    elif filepath.lower().endswith(".jpg") or filepath.lower().endswith(".png"):
-        loader = UnstructuredPaddleImageLoader(filepath, mode="elements")
-        textsplitter = ChineseTextSplitter(pdf=False, sentence_size=sentence_size)
-        docs = loader.load_and_split(text_splitter=textsplitter)
-    elif filepath.lower().endswith(".csv"):
-        loader = CSVLoader(filepath)
-        docs = loader.load()
-    else:
-        loader = UnstructuredFileLoader(filepath, mode="elements")
-        textsplitter = ChineseTextSplitter(pdf=False, sentence_size=sentence_size)
-        docs = loader.load_and_split(text_splitter=textsplitter)
-    return docs
+class Snapshot(NamedTuple):
+    """
+    合并库某一时刻的只读视图，发布后不再修改
+    查询只读取一次self.snapshot，之后一直用这一个快照，写入方整体替换它时不影响正在进行的查询
+    """
+    db: Optional[MyFAISS]
+    chunks: Optional[ChunkStore]
+    tombstones: FrozenSet[int]
+    # 文件名 -> 路径
+    docs: Dict[str, str]
+    version: int
+    # 磁盘上的第几代(见VectorStore._save_generation)
+    generation: int = 0
+
+
+def writer(method):
+    """VectorStore的写操作逐个执行；查询不加锁，只读当前快照"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# manifest中记录的文件
+MANIFEST_KEYS = ("index", "sources", "chunks")
+# 合并库目录里各代的文件，以及旧版本不带代号的文件；不在当前和上一代manifest中的可以删除
+STALE_FILE_PATTERN = re.compile("|".join(
+    rf"{re.escape(os.path.splitext(name)[0])}(\.\d+)?{re.escape(os.path.splitext(name)[1])}$"
+    for name in ("index.faiss", SOURCE_CATALOG_FILE, CHUNK_STORE_FILE, TOMBSTONES_FILE)))
+
+
+def generation_file(name, generation):
+    """第generation代的文件名，如 sources.json -> sources.3.json"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{generation}{ext}"
 
 
 @singleton
 class VectorStore:
     def __init__(self):
-        self.db = None
-        self.old_db = None
-        self.embeddings = OpenAIEmbeddings()
+        # 第一次检索、入库时才创建，见embeddings
+        self._embeddings = None
+        self._embeddings_lock = threading.Lock()
         self.vs_path = None
         self.old_db_path = None
         self.source_dict = {}
+        # 已发布的合并库快照，查询只读它
+        self.snapshot = Snapshot(None, None, frozenset(), {}, 0)
+        # 以下为写入方的状态，只在持有write_lock时读写
+        self.write_lock = threading.RLock()
+        # 本次写入中的合并库私有副本，提交时发布为新快照
+        self._staging = None
+        # 文件目录：文件名 -> 路径、分段数、向量位置区间等
+        self.catalog = None
+        # 合并库分段的磁盘存储，检索命中后按向量位置读取
+        self.chunks = None
+        # 快照的索引是否已完整读入内存；内存映射加载的索引写入前要先从磁盘完整读入
+        self.writable = False
+        # 已删除但尚未压缩的向量位置，查询时跳过
+        self.tombstones = set()
+        # 合并库每次发布新快照时递增，问答缓存据此失效
+        self.version = 0
+        self.answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
+        # 过滤条件 -> IDSelector位图
+        self._selectors = LRUCache(VS_SELECTOR_CACHE_SIZE)
+        # 快照对应的磁盘文件状态，及上次检查其他进程是否改动的时间
+        self._stamp = None
+        self._checked = 0.0
+        # 写入方当前所在一代的manifest：代号及索引、文件目录、分段存储的文件名
+        self._manifest = None
+
+    @property
+    def embeddings(self):
+        """
+        embedding后端在第一次用到时创建：入口脚本在模块级创建VectorStore，
+        创建时就连带导入openai、aiohttp或本地模型会拖慢启动，见benchmarks/import_time.py
+        """
+        if self._embeddings is None:
+            with self._embeddings_lock:
+                if self._embeddings is None:
+                    self._embeddings = get_embeddings(EMBEDDING_PROVIDER)
+        return self._embeddings
+
+    @embeddings.setter
+    def embeddings(self, embeddings):
+        self._embeddings = embeddings
+
+    @property
+    def db(self):
+        return self.snapshot.db
 
-    def load_old_vector_store(self, vs_path=None, kb_name="知识库"):
+    @property
+    def old_db(self):
+        return self.snapshot.db
+
+    @writer
+    def load_old_vector_store(self, vs_path=None, kb_name="知识库", repair=False):
+        """
+        :param repair: 迁移旧版本的存储、丢弃进程异常退出留下的多余分段；
+                       只有执行任务的进程在没有任务执行时可以修复(见repair)，其余情况只读加载，避免截掉写入方正在追加的分段
+        """
         if vs_path is None:
             vs_path = os.path.join(VS_ROOT_PATH, get_pinyin(kb_name))
         self.old_db_path = os.path.join(vs_path, "all_old")
-        if os.path.exists(self.old_db_path):
+        self._staging = None
+        for attempt in range(VS_LOAD_RETRIES):
+            manifest = self._read_manifest()
             try:
-                self.old_db = MyFAISS.load_local(self.old_db_path, self.embeddings)
+                db = self._load_generation(manifest, repair)
+                break
             except Exception as e:
-                logger.info(f"Failed to load  the vector store: {str(e)}")
-                if os.path.isdir(self.old_db_path):
-                    os.makedirs(self.old_db_path)
-                    self.old_db = None
-        return self.old_db
+                if attempt + 1 < VS_LOAD_RETRIES and self._read_manifest() != manifest:
+                    # 读取期间其他进程提交了新的一代并删掉了这一代的文件，按新的manifest重读
+                    continue
+                # 索引文件存在却读不出来(faiss版本、读取标志不兼容、磁盘错误等)时不能按空库处理，
+                # 否则清空分段、下次提交再覆盖索引，整个知识库就丢了；保持不可写，下次写入前重新加载
+                logger.error(f"Failed to load  the vector store: {str(e)}")
+                self.catalog = None
+                self.writable = False
+                raise
+        if repair and db is not None and manifest["generation"] == 0:
+            # 旧版本的目录没有manifest，保存为第1代，墓碑从tombstones.json转入分段存储
+            self._save_generation()
+        self._publish(db)
+        return db
 
-    def create_vector_store(self, documents=None, source="tmp", embeddings=OpenAIEmbeddings(), kb_name="知识库"):
+    def _read_manifest(self):
+        """当前一代的manifest；旧版本的目录没有manifest，按第0代、不带代号的文件名读取"""
+        try:
+            with open(os.path.join(self.old_db_path, MANIFEST_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"generation": 0, "index": "index.faiss", "sources": SOURCE_CATALOG_FILE,
+                    "chunks": CHUNK_STORE_FILE}
+
+    def _load_generation(self, manifest, repair):
+        self._manifest = manifest
+        # 旧快照的分段存储不主动关闭，正在进行的查询还在读它，不再被引用后自动关闭
+        self.chunks = ChunkStore(os.path.join(self.old_db_path, manifest["chunks"]))
+        self.writable = False
+        db = None
+        # 只有还没有写过索引的旧版本目录按空库处理，有manifest时索引文件必须存在
+        if manifest["generation"] > 0 or os.path.exists(os.path.join(self.old_db_path, manifest["index"])):
+            if repair and os.path.exists(os.path.join(self.old_db_path, "index.pkl")):
+                self._migrate_docstore()
+            self.writable = VS_LOAD_MODE != "mmap"
+            db = self._read_db(mmap=not self.writable)
+        self._load_index_meta(db, repair)
+        return db
+
+    def _disk_stamp(self):
+        """manifest等文件的(inode, 修改时间)，其他进程提交或压缩后会变化"""
+        stamp = []
+        # 旧版本的目录没有manifest，直接看索引文件
+        for name in (MANIFEST_FILE, "index.faiss"):
+            try:
+                st = os.stat(os.path.join(self.old_db_path, name))
+                stamp.append((st.st_ino, st.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def reload_if_changed(self, force=False, repair=False):
+        """
+        多进程部署(多个API worker、后台任务进程)时合并库由执行任务的进程写入，其余进程据磁盘文件的变化重新加载快照
+        每VS_RELOAD_CHECK_SECONDS秒最多检查一次，force时立即检查；本进程正在写入时跳过
+        :return: 是否重新加载了
+        """
+        now = time.monotonic()
+        if self.old_db_path is None or not force and now - self._checked < VS_RELOAD_CHECK_SECONDS:
+            return False
+        self._checked = now
+        if not self.write_lock.acquire(blocking=False):
+            return False
+        try:
+            if self._disk_stamp() == self._stamp:
+                return False
+            logger.info(f"{self.old_db_path}已被其他进程改动，重新加载")
+            try:
+                self.load_old_vector_store(os.path.dirname(self.old_db_path), repair=repair)
+            except Exception:
+                # 读不出来时继续用旧快照回答查询，下次检查时再试
+                return False
+            return True
+        finally:
+            self.write_lock.release()
+
+    def _migrate_docstore(self):
+        """旧版本的合并库把分段pickle在index.pkl里，导出到分段存储和文件目录后删除"""
+        db = MyFAISS.load_local(self.old_db_path, self.embeddings)
+        docs = [db.docstore.search(db.index_to_docstore_id[i]) for i in range(db.index.ntotal)]
+        self.chunks.close()
+        if self.chunks.exists():
+            os.remove(self.chunks.path)
+        self.chunks = ChunkStore.from_documents(self.chunks.path, docs)
+        catalog_path = os.path.join(self.old_db_path, SOURCE_CATALOG_FILE)
+        if not os.path.exists(catalog_path):
+            SourceCatalog.from_documents(catalog_path, docs).save()
+        # 上一版的jsonl分段存储
+        shutil.rmtree(os.path.join(self.old_db_path, "chunks"), ignore_errors=True)
+        os.remove(os.path.join(self.old_db_path, "index.pkl"))
+        logger.info(f"已把{len(docs)}个分段从docstore迁移到{self.chunks.path}")
+
+    def _read_db(self, mmap=False):
+        """
+        合并库只由faiss索引文件和分段存储组成，不再有docstore
+        mmap时只内存映射索引文件，分段从self.chunks按需读取
+        """
+        # 新版faiss的IO_FLAG_MMAP_IFC直接映射文件内容；两个标志同时给时IVF索引会读取失败，只能二选一
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) if mmap else 0
+        index = faiss.read_index(os.path.join(self.old_db_path, self._manifest["index"]), flags)
+        return MyFAISS(self.embeddings.embed_query, index, InMemoryDocstore({}), {})
+
+    def _staging_db(self):
+        """
+        返回本次写入可以增删向量的合并库副本
+        快照的索引正被并发查询，不能原地修改(faiss追加向量会重新分配内存)：内存中的索引复制一份，
+        内存映射的索引从磁盘完整读入(对映射的索引追加向量faiss会直接abort)
+        """
+        db = self.snapshot.db
+        if self._staging is None and db is not None:
+            index = faiss.clone_index(db.index) if self.writable else self._read_db().index
+            self._staging = MyFAISS(self.embeddings.embed_query, index, InMemoryDocstore({}), {})
+        return self._staging
+
+    def _load_index_meta(self, db, repair=True):
+        generation = self._manifest["generation"]
+        self.catalog = SourceCatalog(os.path.join(self.old_db_path, self._manifest["sources"]))
+        self.tombstones = set()
+        if db is None:
+            # 索引文件确实不存在：之前的进程在第一次保存索引前退出，丢弃它写入的分段
+            if repair and self.chunks.exists():
+                self.chunks.truncate(0)
+            return
+        if repair:
+            # 分段先于manifest落盘，进程在切换到新一代之前退出时丢弃多出的分段和没有提交的墓碑
+            if len(self.chunks) > db.index.ntotal:
+                self.chunks.truncate(db.index.ntotal)
+            self.chunks.discard_tombstones(generation)
+        if os.path.exists(self.catalog.path):
+            self.catalog = SourceCatalog.load(self.catalog.path)
+        else:
+            self.catalog = SourceCatalog.from_documents(self.catalog.path, self.chunks.iter_documents())
+        self.tombstones = self.chunks.tombstones(generation)
+        tombstones_path = os.path.join(self.old_db_path, TOMBSTONES_FILE)
+        if generation == 0 and os.path.exists(tombstones_path):
+            with open(tombstones_path, encoding="utf-8") as f:
+                self.tombstones.update(json.load(f))
+
+    def _save_generation(self, index=None, chunks=None):
+        """
+        把写入方的当前状态保存为新的一代：改动过的索引、文件目录各写一个带代号的新文件，墓碑记入分段存储，
+        最后替换manifest.json一次切换过去；中途退出时manifest仍指向完整的上一代，多写的分段和墓碑在修复时丢弃
+        :param chunks: 压缩后重新编号的分段存储，为None时沿用当前的
+        """
+        previous = self._manifest
+        generation = previous["generation"] + 1
+        manifest = dict(previous, generation=generation,
+                        sources=generation_file(SOURCE_CATALOG_FILE, generation))
+        os.makedirs(self.old_db_path, exist_ok=True)
+        if index is not None:
+            manifest["index"] = generation_file("index.faiss", generation)
+            faiss.write_index(index, os.path.join(self.old_db_path, manifest["index"]))
+        chunks = chunks or self.chunks
+        manifest["chunks"] = os.path.basename(chunks.path)
+        chunks.add_tombstones(self.tombstones, generation)
+        self.catalog.save(os.path.join(self.old_db_path, manifest["sources"]))
+        manifest_path = os.path.join(self.old_db_path, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        self._manifest = manifest
+        self.catalog.path = os.path.join(self.old_db_path, manifest["sources"])
+        self.chunks = chunks
+        self._remove_stale_files(previous, manifest)
+
+    def _remove_stale_files(self, previous, current):
+        """
+        删除上一代之前的文件；上一代的文件保留到下一次提交，其他进程在重新加载前还能继续读它
+        删除失败(如Windows上仍被映射)时留到以后再删
+        """
+        keep = {previous[key] for key in MANIFEST_KEYS} | {current[key] for key in MANIFEST_KEYS}
+        for name in os.listdir(self.old_db_path):
+            base = re.sub(r"(-wal|-shm|-journal)$", "", name)
+            if base in keep or not name.endswith(".tmp") and not STALE_FILE_PATTERN.match(base):
+                continue
+            try:
+                os.remove(os.path.join(self.old_db_path, name))
+            except OSError:
+                pass
+
+    def _publish(self, db):
+        """把写入方的当前状态发布为新快照，一次赋值完成替换"""
+        self.version += 1
+        docs = self.catalog.docs_dict() if db is not None and self.catalog is not None else {}
+        generation = self._manifest["generation"] if self._manifest is not None else 0
+        self.snapshot = Snapshot(db, self.chunks, frozenset(self.tombstones), docs, self.version, generation)
+        if db is not None and db is self._staging:
+            self.writable = True
+        self._staging = None
+        self.answer_cache.clear()
+        self._selectors.clear()
+        if self.old_db_path is not None:
+            self._stamp = self._disk_stamp()
+
+    @writer
+    def create_vector_store(self, documents=None, source="tmp", embeddings=None, kb_name="知识库"):
+        if embeddings is None:
+            embeddings = self.embeddings
         vs_path = os.path.join(VS_ROOT_PATH, get_pinyin(kb_name))
         self.vs_path = vs_path
-        self.old_db = self.load_old_vector_store(vs_path=self.vs_path)
+        self.load_old_vector_store(vs_path=self.vs_path)
         if documents is not None:
             try:
-                if self.old_db is not None:
-                    db_tmp = MyFAISS.from_documents(documents, embeddings)
-                    db_tmp_path = os.path.join(self.vs_path, get_pinyin(source))
-                    db_tmp.save_local(db_tmp_path)
-                    self.old_db.add_documents(documents)
-                    self.db = self.old_db
-                else:
-                    db_tmp = MyFAISS.from_documents(documents, embeddings)
-                    db_tmp_path = os.path.join(self.vs_path, get_pinyin(source))
-                    db_tmp.save_local(db_tmp_path)
-                    self.db = MyFAISS.from_documents(documents, embeddings)
+                texts = [doc.page_content for doc in documents]
+                # 只embedding一次，单文件库和合并库共用同一批向量
+                self._add_embedded_documents(source, documents, embeddings.embed_documents(texts), embeddings)
             except Exception as e:
                 logger.info(f"Failed to create the vector store: {str(e)}")
+                self._rollback()
+                return
+            # 只加载不写入时不再保存，启动耗时与库大小无关
+            self._commit_vector_store()
+
+    @writer
+    def load_knowledge_base(self, kb_name="知识库"):
+        """切换到kb_name对应的知识库，已经加载的不重复加载"""
+        vs_path = os.path.join(VS_ROOT_PATH, get_pinyin(kb_name))
+        if self.vs_path != vs_path or self.catalog is None:
+            self.vs_path = vs_path
+            self.load_old_vector_store(vs_path=self.vs_path)
+
+    @writer
+    def repair(self, kb_name="知识库"):
+        """
+        从磁盘重新加载kb_name对应的合并库并修复，见load_old_vector_store的repair参数
+        只能由持有任务队列锁文件的进程在两个任务之间调用，此时没有其他进程在写合并库
+        """
+        self.vs_path = os.path.join(VS_ROOT_PATH, get_pinyin(kb_name))
+        self.load_old_vector_store(vs_path=self.vs_path, repair=True)
+
+    @writer
+    def add_embedded_documents(self, batch, kb_name="知识库"):
+        """
+        把多个文件已经embedding好的分段一次写入合并库，整批只保存一次
+        :param batch: [(source, documents, vectors), ...]
+        """
+        self.load_knowledge_base(kb_name)
+        try:
+            for source, documents, vectors in batch:
+                self._add_embedded_documents(source, documents, vectors, self.embeddings)
+        except Exception:
+            # 整批作废：失败的文件不能在下次提交时出现，它们的旧版本也不能被删掉
+            self._rollback()
+            raise
+        self._commit_vector_store()
+
+    @writer
+    def update_file_stats(self, filenames):
+        """内容没变只是修改时间变了的文件，更新目录里记录的大小和修改时间"""
+        for filename in filenames:
+            size, mtime = file_stat(self.catalog.sources[filename]["path"])
+            self.catalog.sources[filename].update(size=size, mtime=mtime)
+        self.catalog.save()
+
+    def _add_embedded_documents(self, source, documents, vectors, embeddings):
+        texts = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        text_embeddings = list(zip(texts, vectors))
+        db_tmp = MyFAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
+        db_tmp_path = os.path.join(self.vs_path, get_pinyin(source))
+        db_tmp.save_local(db_tmp_path)
+        db = self._staging_db()
+        # 同名文件重新上传时，删除旧版本的向量
+        for filename in {os.path.basename(doc.metadata.get("source")) for doc in documents}:
+            if filename in self.catalog:
+                self.tombstones.update(*(range(start, end) for start, end in self.catalog.remove(filename)))
+        # 合并库只往索引里追加向量，分段写入分段存储，不再经过docstore
+        vectors = np.array(vectors, dtype=np.float32)
+        if db is None:
+            db = MyFAISS(embeddings.embed_query, faiss.IndexFlatL2(vectors.shape[1]), InMemoryDocstore({}), {})
+            self._staging = db
+        if getattr(db, "_normalize_L2", False):
+            faiss.normalize_L2(vectors)
+        start = db.index.ntotal
+        db.index.add(vectors)
+        # 追加的分段位置在快照的向量数之后，查询旧快照时不会读到
+        self.chunks.append(documents, start)
+        self.catalog.add(documents, start)
+
+    def _rollback(self):
+        """丢弃本次写入暂存的改动(索引副本、墓碑、文件目录、追加的分段)，写入方状态回到当前快照"""
+        snapshot = self.snapshot
+        self._staging = None
+        self.tombstones = set(snapshot.tombstones)
+        # 快照之后追加的分段位置在快照的向量数之后，查询不会读到，可以直接截掉；提交到一半写入的墓碑属于下一代，也丢弃
+        if self.chunks is not None and self.chunks.exists():
+            self.chunks.truncate(snapshot.db.index.ntotal if snapshot.db is not None else 0)
+            self.chunks.discard_tombstones(self._manifest["generation"])
+        # 文件目录在每次提交时落盘，与加载时一样从磁盘重建
+        catalog_path = os.path.join(self.old_db_path, self._manifest["sources"])
+        if os.path.exists(catalog_path):
+            self.catalog = SourceCatalog.load(catalog_path)
+        elif snapshot.db is not None:
+            self.catalog = SourceCatalog.from_documents(catalog_path, self.chunks.iter_documents())
         else:
-            self.db = self.old_db
-        if self.db is not None:
-            self.db.save_local(self.old_db_path)
+            self.catalog = SourceCatalog(catalog_path)
+
+    def _commit_vector_store(self):
+        db = self._staging or self.snapshot.db
+        if db is None:
+            return
+        try:
+            if len(self.tombstones) > db.index.ntotal * VS_COMPACT_RATIO:
+                self.compact_vector_store()
+                return
+            if self._staging is not None:
+                self._maybe_train_index()
+            # 只删除文件时索引没有改动，新的一代沿用原来的索引文件
+            self._save_generation(self._staging.index if self._staging is not None else None)
+        except Exception:
+            # 没有切换到新的一代，磁盘上仍是快照对应的那一代
+            self._rollback()
+            raise
+        self._publish(db)
 
+    def _maybe_train_index(self):
+        """合并库达到训练阈值后，把暴力检索的Flat索引转成配置的近似索引，向量位置不变"""
+        index = self._staging.index
+        if VS_INDEX_TYPE == "flat" or not is_flat(index) or index.ntotal < VS_INDEX_TRAIN_THRESHOLD:
+            return
+        logger.info(f"合并库向量数{index.ntotal}达到阈值，训练{VS_INDEX_TYPE}索引")
+        self._staging.index = convert_index(index, VS_INDEX_TYPE)
+
+    @writer
     def delete_vector_store(self):
         if os.path.exists(self.vs_path):
             try:
+                chunks = self.chunks
+                self.catalog = None
+                self.chunks = None
+                self.tombstones = set()
+                self._staging = None
+                self._publish(None)
+                if chunks is not None:
+                    chunks.close()
                 shutil.rmtree(self.vs_path)
-                self.db = None
-                self.old_db = None
                 info = "已清除数据库"
                 return info
             except Exception as e:
@@ -161,58 +549,180 @@ class VectorStore:
         :param source: 删除的文件名basename
         :return: 文件删除信息
         """
+        return self.delete_vector_stores([source])
+
+    @writer
+    def delete_vector_stores(self, sources):
+        """
+        删除多个文件，全部打上墓碑后只保存或压缩一次合并库
+        :param sources: 删除的文件名basename列表
+        :return: 文件删除信息
+        """
         info = ''
-        delete_path = os.path.join(self.vs_path, get_pinyin(source.split('.')[0]))
-        if os.path.exists(delete_path):
-            try:
-                info += f"成功删除{source}文件"
-                shutil.rmtree(delete_path)
-            except Exception as e:
-                info += f"无法删除{source}文件，错误码{e}\n"
-        self.source_dict = self.get_docs_dict()
-        if source in self.source_dict:
-            del self.source_dict[source]
-        else:
-            info += f"文件{source}不存在"
-        first_db = True
-        if len(self.source_dict) > 0:
-            for key, value in self.source_dict.items():
-                tmp_db_path = os.path.join(self.vs_path, get_pinyin(str(key).split('.')[0]))
+        deleted = False
+        for source in sources:
+            delete_path = os.path.join(self.vs_path, get_pinyin(source.split('.')[0]))
+            if os.path.exists(delete_path):
                 try:
-                    if first_db is True:
-                        self.db = MyFAISS.load_local(tmp_db_path, self.embeddings)
-                        first_db = False
-                    else:
-                        tmp_db = MyFAISS.load_local(tmp_db_path, self.embeddings)
-                        self.db.merge_from(tmp_db)
-                    self.db.save_local(self.old_db_path)
+                    info += f"成功删除{source}文件"
+                    shutil.rmtree(delete_path)
                 except Exception as e:
-                    info += f"{key}重新加载失败，错误码:{e}\n"
-        else:
-            self.db = None
+                    info += f"无法删除{source}文件，错误码{e}\n"
+            if self.catalog is None or source not in self.catalog:
+                info += f"文件{source}不存在"
+                continue
+            # 只给该文件的向量打上墓碑，不再逐个重载其余文件的库重新合并
+            for start, end in self.catalog.remove(source):
+                self.tombstones.update(range(start, end))
+            deleted = True
+        if not deleted:
+            return info
+        if len(self.catalog) == 0:
+            self.tombstones = set()
+            self._staging = None
+            self._publish(None)
+            self.chunks.close()
             shutil.rmtree(self.old_db_path)
+        else:
+            self._commit_vector_store()
         return info
 
+    @writer
+    def compact_vector_store(self):
+        """
+        把打了墓碑的向量从合并库和分段存储中真正删除
+        删除后后面的向量依次前移，分段存储要整表重新编号，与正在查询旧快照的线程和进程冲突，
+        所以重新编号的分段存储写到下一代的新文件，与索引、文件目录一起随manifest切换
+        """
+        if self.snapshot.db is None and self._staging is None or not self.tombstones:
+            return
+        db = self._staging_db()
+        removed = sorted(self.tombstones)
+        generation = self._manifest["generation"] + 1
+        db.index = remove_positions(db.index, removed)
+        chunks = self.chunks.compact_to(
+            os.path.join(self.old_db_path, generation_file(CHUNK_STORE_FILE, generation)), removed)
+        self.catalog.remap(removed)
+        self.tombstones = set()
+        self._save_generation(db.index, chunks)
+        self._publish(db)
+
+    def similarity_search_with_score(self, query, k=4, nprobe=None, ef_search=None, filter=None):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k=k,
+                                                           nprobe=nprobe, ef_search=ef_search, filter=filter)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, nprobe=None, ef_search=None, filter=None):
+        """
+        与FAISS.similarity_search_with_score_by_vector相同，但会跳过已删除的向量
+        nprobe/ef_search只作用于本次查询，为None时使用配置的默认值，Flat索引忽略
+        filter见batch_similarity_search_with_score_by_vector
+        """
+        return self.batch_similarity_search_with_score_by_vector([embedding], k=k, nprobe=nprobe,
+                                                                 ef_search=ef_search, filter=filter)[0]
+
+    def batch_similarity_search_with_score(self, queries, k=4, nprobe=None, ef_search=None, filter=None):
+        """多个问题一次embedding请求、一次矩阵检索，返回与queries一一对应的 [(Document, score), ...]"""
+        if not queries:
+            return []
+        return self.batch_similarity_search_with_score_by_vector(self.embeddings.embed_queries(queries), k=k,
+                                                                 nprobe=nprobe, ef_search=ef_search, filter=filter)
+
+    def batch_similarity_search_with_score_by_vector(self, embeddings, k=4, nprobe=None, ef_search=None, filter=None):
+        """
+        :param embeddings: 多个问题向量，在faiss中作为一个矩阵一次检索
+        :param filter: metadata过滤条件 {键: 值或值的列表}，如 {"source": 路径, "category": "cn_Title"}，
+                       在faiss检索内部过滤，满足条件的分段足够时总能返回k个
+        :return: 每个问题的前k个 [(Document, score), ...]
+        """
+        snapshot = self.snapshot
+        hits = self._vector_search_batch(snapshot, embeddings, k, nprobe, ef_search, filter)
+        # 所有问题命中的分段一次读出
+        positions = list(dict.fromkeys(i for query_hits in hits for i, _ in query_hits))
+        docs = dict(zip(positions, snapshot.chunks.get(positions))) if positions else {}
+        return [[(docs[i], score) for i, score in query_hits] for query_hits in hits]
+
+    def _selector(self, snapshot, filter=None):
+        """
+        未删除且满足filter的向量位置对应的IDSelector，没有墓碑也没有过滤条件时为None
+        位图按快照和过滤条件缓存，各部门反复查询同一来源时不再查分段存储
+        :return: (selector, 选中的向量数)
+        """
+        ntotal = snapshot.db.index.ntotal
+        if not filter and not snapshot.tombstones:
+            return None, ntotal
+        key = (snapshot.version, json.dumps(filter or {}, sort_keys=True, default=list))
+        cached = self._selectors.get(key)
+        if cached is None:
+            if filter:
+                mask = np.zeros(ntotal, dtype=bool)
+                ids = np.array(snapshot.chunks.filter_ids(filter), dtype=np.int64)
+                mask[ids[ids < ntotal]] = True
+            else:
+                mask = np.ones(ntotal, dtype=bool)
+            mask[[i for i in snapshot.tombstones if i < ntotal]] = False
+            cached = (id_selector(mask), int(mask.sum()))
+            self._selectors.put(key, cached)
+        return cached
+
+    def _vector_search_batch(self, snapshot, embeddings, k, nprobe=None, ef_search=None, filter=None):
+        """每个问题返回未删除且满足filter的前k个 (向量位置, 距离)"""
+        db = snapshot.db
+        if db is None or db.index.ntotal == 0:
+            return [[] for _ in embeddings]
+        selector, selected = self._selector(snapshot, filter)
+        if selected == 0:
+            return [[] for _ in embeddings]
+        vectors = np.array(embeddings, dtype=np.float32)
+        if getattr(db, "_normalize_L2", False):
+            faiss.normalize_L2(vectors)
+        # 墓碑和过滤条件都由selector在索引内部跳过，不必多取再丢弃
+        k = min(k, selected)
+        scores, indices = db.index.search(vectors, k, params=search_params(db.index, nprobe, ef_search, selector))
+        if selector is not None and not is_flat(db.index) and (indices == -1).any():
+            # 过滤条件很严时，近似索引探查的聚类/候选里可能凑不够k个，这些问题放宽到全部聚类、更大的候选集重查
+            short = np.nonzero((indices == -1).any(axis=1))[0]
+            ef_search = min(db.index.ntotal, (ef_search or VS_EF_SEARCH) * -(-db.index.ntotal // selected))
+            params = search_params(db.index, db.index.ntotal, ef_search, selector)
+            scores[short], indices[short] = db.index.search(vectors[short], k, params=params)
+        return [[(int(i), float(score)) for i, score in zip(row_indices, row_scores) if i != -1]
+                for row_indices, row_scores in zip(indices, scores)]
+
+    def _lexical_search(self, snapshot, query, k, filter=None):
+        """返回未删除且满足filter的前k个BM25命中的向量位置"""
+        # 墓碑按快照的代在SQL中跳过；写入方正在追加、还未发布的分段位置不小于快照的向量数
+        hits = snapshot.chunks.lexical_search(query, k, filter=filter, generation=snapshot.generation,
+                                              end=snapshot.db.index.ntotal)
+        # 还没迁移的旧版本目录(第0代)墓碑只在tombstones.json里，再按快照过滤一遍
+        return [i for i, _ in hits if i not in snapshot.tombstones]
+
+    def hybrid_search_with_score(self, query, embedding, k=4, vector_weight=HYBRID_VECTOR_WEIGHT,
+                                 lexical_weight=HYBRID_LEXICAL_WEIGHT, nprobe=None, ef_search=None, filter=None):
+        """
+        向量检索与BM25关键词检索各取HYBRID_CANDIDATES个候选，按加权倒数排名融合(RRF)
+        返回的分数是归一化到[0, 1]的融合分数，两路都排第一时为1
+        """
+        snapshot = self.snapshot
+        if snapshot.db is None or snapshot.db.index.ntotal == 0:
+            return []
+        candidates = max(k, HYBRID_CANDIDATES)
+        vector_hits = [i for i, _ in self._vector_search_batch(snapshot, [embedding], candidates, nprobe, ef_search,
+                                                               filter)[0]]
+        lexical_hits = self._lexical_search(snapshot, query, candidates, filter)
+        fused = reciprocal_rank_fusion([vector_hits, lexical_hits], [vector_weight, lexical_weight], HYBRID_RRF_K)[:k]
+        docs = snapshot.chunks.get([i for i, _ in fused])
+        return [(doc, score) for doc, (_, score) in zip(docs, fused)]
+
+    def to_similarity(self, docs_and_scores):
+        """
+        把向量检索返回的分数换算成越大越相关的相似度，与hybrid_search_with_score的分数方向一致，可以用同一个阈值过滤
+        L2索引返回平方距离d，两个单位向量(两种embedding后端的向量都是归一化的)的余弦相似度为1-d/2；内积索引的分数本身就是相似度
+        """
+        db = self.snapshot.db
+        if db is not None and db.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            return docs_and_scores
+        return [(doc, 1 - score / 2) for doc, score in docs_and_scores]
+
     def get_docs_dict(self):
-        # 创建一个空列表
-        source_list = []
-        if not isinstance(self.source_dict, dict):
-            self.source_dict = {}
-        if self.db is not None:
-            for key, value in self.db.docstore._dict.items():
-                # 获取每个文档的元数据
-                metadata = value.metadata
-                # 获取每个文档的source属性
-                source = metadata.get('source')
-                # 将source添加到列表中
-                source_list.append(source)
-            source_set = set(source_list)
-            # 遍历列表中的路径
-            for path in source_set:
-                # 使用os.path.basename()函数获取路径的文件名
-                filename = os.path.basename(path)
-                # 使用文件名作为键，路径作为值，添加到字典中
-                self.source_dict[filename] = path
-            return self.source_dict
-        else:
-            return {}
+        """文件名 -> 路径，取自快照里的文件目录，不再遍历docstore"""
+        self.source_dict = dict(self.snapshot.docs)
+        return self.source_dict